@@ -0,0 +1,214 @@
+"""
+Admission control for concurrent git transfers.
+
+`AdmissionControl` limits how many sessions may run at once, globally, per
+user, and per repository.  A session holds one slot in every scope that has
+a limit; sessions that cannot get their slots wait in line and are told
+where they stand.  There is a first-come, first-served queue for every
+scope (e.g. for each repository), and a session only waits behind earlier
+sessions that are queued for one of the scopes it needs.
+
+Slots and queue entries are files in a state directory, locked with
+flock(2).  The kernel drops the locks when a process exits, so a crashed
+session can never leak a slot.  The locked file descriptors are inherited
+across exec, so a session that hands off to git keeps its slot until git
+exits.
+"""
+
+# Make Python 2 act like Python 3.
+from __future__ import with_statement, division
+__metaclass__ = type        # default to new-style classes
+
+import sys, os
+import os.path
+import errno
+import fcntl
+import hashlib
+import time
+
+
+def _makedirs(path):
+    try:
+        os.makedirs(path)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _trylock(filename):
+    """Open `filename` and try to lock it exclusively without blocking.
+    Returns the file descriptor, or None if someone else holds the lock."""
+    fd = os.open(filename, os.O_RDWR | os.O_CREAT, 0666)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except IOError, e:
+        os.close(fd)
+        if e.errno in (errno.EAGAIN, errno.EACCES):
+            return None
+        raise
+    return fd
+
+
+class Ticket:
+    """The slots held by an admitted session.  They are released by
+    `release()`, or when the process (or whatever it exec's) exits."""
+
+    def __init__(self, fds):
+        self.fds = fds
+
+    def release(self):
+        for fd in self.fds:
+            os.close(fd)
+        self.fds = []
+
+
+class AdmissionControl:
+    """
+    Admit sessions subject to `limits`, a dictionary mapping 'global',
+    'user', and 'repo' to the maximum number of concurrent sessions in that
+    scope (0 or missing means unlimited).  `state_dir` holds the slot and
+    queue files and must be shared by every server process.
+    """
+
+    POLL = 0.2
+    NOTIFY_INTERVAL = 10.0
+
+    def __init__(self, state_dir, limits):
+        self.state_dir = state_dir
+        self.limits = limits
+        self.queue_dir = os.path.join(state_dir, 'queue')
+
+    def _slot_dirs(self, user, repo):
+        """Return a list of (slot directory, queue directory, limit) for
+        every limited scope."""
+        keys = {
+                'global' : 'all',
+                'user' : user,
+                'repo' : hashlib.sha1(os.path.realpath(repo)).hexdigest(),
+                }
+        out = []
+        for scope in ('repo', 'user', 'global'):
+            limit = self.limits.get(scope)
+            if limit:
+                out.append((os.path.join(self.state_dir, 'slots', scope,
+                                         keys[scope]),
+                            os.path.join(self.queue_dir, scope, keys[scope]),
+                            limit))
+        return out
+
+    def _try_acquire(self, slot_dirs):
+        """Take one slot in every scope, or none at all.  Returns (`fds`,
+        `full`): the list of locked file descriptors (or None), and the
+        queue directories of the scopes that had no free slot."""
+        fds = []
+        full = []
+        for dirname, queue_dir, limit in slot_dirs:
+            _makedirs(dirname)
+            for i in range(limit):
+                fd = _trylock(os.path.join(dirname, str(i)))
+                if fd is not None:
+                    fds.append(fd)
+                    break
+            else:
+                full.append(queue_dir)
+        if full:
+            for fd in fds:
+                os.close(fd)
+            return None, full
+        return fds, full
+
+    def _waiters(self, queue_dir):
+        """Return the sorted names of the entries in `queue_dir`.  Entries
+        left at the head of the queue by dead processes are removed; the
+        others are dealt with when they reach the head."""
+        try:
+            names = sorted(os.listdir(queue_dir))
+        except OSError:
+            return []
+        while names:
+            path = os.path.join(queue_dir, names[0])
+            try:
+                fd = _trylock(path)
+            except OSError:
+                fd = None
+            if fd is None:
+                # Still waiting (or it is us: flock(2) locks belong to the
+                # open file, so our own entry is locked even to us).
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            os.close(fd)
+            names.pop(0)
+        return names
+
+    @staticmethod
+    def _leave(queue_dir, name, fd):
+        try:
+            os.remove(os.path.join(queue_dir, name))
+        except OSError:
+            pass
+        if fd is not None:
+            os.close(fd)
+
+    def acquire(self, user, repo, out=sys.stderr):
+        """Wait until the session for `user` on repository `repo` may run,
+        writing progress messages to `out`.  Returns a `Ticket`."""
+        slot_dirs = self._slot_dirs(user, repo)
+        if not slot_dirs:
+            return Ticket([])
+
+        # Every scope key has its own queue.  A waiting session is in the
+        # queues of exactly the scopes that hold it up, i.e. that are full
+        # or have earlier sessions waiting, so a session waiting for a busy
+        # repository never holds up sessions on other repositories.  Queue
+        # entries are named by arrival time, so a session that joins a queue
+        # late still takes its turn in order of arrival.
+        name = '%020d-%d' % (int(time.time() * 1e6), os.getpid())
+        queued = {}         # queue directory -> locked file descriptor
+        last_position = None
+        last_notify = 0
+        try:
+            while True:
+                ahead = {}
+                for dirname, queue_dir, limit in slot_dirs:
+                    ahead[queue_dir] = len([n for n in
+                            self._waiters(queue_dir) if n < name])
+                fds, full = self._try_acquire([s for s in slot_dirs
+                                               if not ahead[s[1]]])
+                if fds is not None:
+                    if not any(ahead.values()):
+                        if last_position is not None:
+                            out.write("Starting.\n")
+                            out.flush()
+                        return Ticket(fds)
+                    for fd in fds:
+                        os.close(fd)
+                blocking = set(full)
+                blocking.update(q for q in ahead if ahead[q])
+                for queue_dir in blocking:
+                    if queue_dir not in queued:
+                        _makedirs(queue_dir)
+                        queued[queue_dir] = _trylock(
+                                os.path.join(queue_dir, name))
+                for queue_dir in list(queued):
+                    if queue_dir not in blocking:
+                        self._leave(queue_dir, name, queued.pop(queue_dir))
+                position = max(ahead.values())
+                now = time.time()
+                if (position != last_position
+                        or now - last_notify >= self.NOTIFY_INTERVAL):
+                    if position:
+                        out.write("Server busy; waiting for a free slot "
+                                  "(%d ahead of you)...\n" % position)
+                    else:
+                        out.write("Server busy; waiting for a free slot "
+                                  "(next in line)...\n")
+                    out.flush()
+                    last_position = position
+                    last_notify = now
+                time.sleep(self.POLL)
+        finally:
+            for queue_dir, fd in queued.iteritems():
+                self._leave(queue_dir, name, fd)
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+"""\
+Compare the cost of forking a repository by cloning and by copying files.
+
+USAGE: %prog [-n COMMITS] [directory]
+
+A scratch repository with COMMITS commits (default 200) of random data is
+created in a temporary directory under `directory` (default: the current
+directory), and then copied with "git clone --mirror" and with
+cowcopy.copy_repository().  The wall time and the disk space added by each
+copy are printed.  Run it on the filesystem that holds your repositories:
+if that filesystem supports reflinks, the file copy is copy-on-write and
+should take almost no time or space; otherwise it is an ordinary copy.
+"""
+
+from __future__ import print_function
+
+import sys, os
+import shutil
+import subprocess
+import tempfile
+import time
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC)
+
+import cowcopy
+
+
+def used_blocks(path):
+    st = os.statvfs(path)
+    return (st.f_blocks - st.f_bfree) * st.f_frsize
+
+
+def make_repository(path, commits):
+    work = path + '.work'
+    subprocess.check_call(['git', 'init', '-q', work])
+    git = ['git', '-C', work, '-c', 'user.name=bench',
+           '-c', 'user.email=bench@example.com']
+    for i in range(commits):
+        f = open(os.path.join(work, 'file%d' % (i % 20)), 'ab')
+        f.write(os.urandom(4096))
+        f.close()
+        subprocess.check_call(git + ['add', '-A'])
+        subprocess.check_call(git + ['commit', '-q', '-m', str(i)])
+    subprocess.check_call(['git', 'clone', '-q', '--bare', work, path])
+    shutil.rmtree(work)
+    subprocess.check_call(['git', '--git-dir=%s' % path, 'gc', '-q'])
+
+
+def measure(tmpdir, name, function):
+    subprocess.call(['sync'])
+    before = used_blocks(tmpdir)
+    start = time.time()
+    function()
+    elapsed = time.time() - start
+    subprocess.call(['sync'])
+    added = used_blocks(tmpdir) - before
+    print('%-28s %8.1fms %10.1f KiB' % (name, elapsed * 1000, added / 1024))
+
+
+def main(argv):
+    commits = 200
+    args = argv[1:]
+    if args[:1] == ['-n']:
+        commits = int(args[1])
+        args = args[2:]
+    directory = args[0] if args else '.'
+
+    tmpdir = tempfile.mkdtemp(dir=directory)
+    try:
+        src = os.path.join(tmpdir, 'src.git')
+        make_repository(src, commits)
+        reflink = cowcopy.supports_reflink(tmpdir)
+        print('reflinks supported: %s' % ('yes' if reflink else 'no'))
+        print('%-28s %10s %14s' % ('method', 'time', 'space'))
+        measure(tmpdir, 'git clone --mirror',
+                lambda: subprocess.check_call(['git', 'clone', '-q',
+                    '--mirror', src, os.path.join(tmpdir, 'clone.git')]))
+        measure(tmpdir, 'cowcopy (%s)' % ('reflink' if reflink else 'copy'),
+                lambda: cowcopy.copy_repository(src,
+                    os.path.join(tmpdir, 'copy.git')))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""\
+Measure how long it takes to find every repository under a base path.
+
+USAGE: %prog [-n RUNS] base_path [jobs ...]
+
+The tree is walked RUNS times (default 5) with os.walk(), as the server
+used to, and with treescan.scan_tree() using each number of threads given
+(default 1, 4, and 16).  The median wall time and the number of
+repositories found are printed.  Run it against the real base path: on
+local disks the directory cache hides most of the cost, while on NFS the
+threads overlap the round trips of different owners.
+"""
+
+from __future__ import print_function
+
+import sys, os
+import time
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, SRC)
+
+import treescan
+
+
+def os_walk(base_path):
+    base_path = os.path.join(base_path, '')
+    out = []
+    for root, dirs, files in os.walk(base_path):
+        if root.endswith('.git'):
+            dirs[:] = []
+            out.append(root[len(base_path):])
+    out.sort()
+    return out
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def measure(function, runs):
+    times = []
+    for i in range(runs):
+        start = time.time()
+        n = len(function())
+        times.append(time.time() - start)
+    return median(times), n
+
+
+def main(argv):
+    runs = 5
+    args = argv[1:]
+    if args[:1] == ['-n']:
+        runs = int(args[1])
+        args = args[2:]
+    if not args:
+        print(__doc__.replace('%prog', argv[0]), file=sys.stderr)
+        return 1
+    base_path = args[0]
+    jobs = [int(j) for j in args[1:]] or [1, 4, 16]
+
+    print('scandir: %s' % ('yes' if treescan.scandir else 'no (lstat)'))
+    print('%-24s %10s %8s' % ('method', 'median', 'repos'))
+    t, n = measure(lambda: os_walk(base_path), runs)
+    print('%-24s %8.1fms %8d' % ('os.walk', t * 1000, n))
+    for j in jobs:
+        t, n = measure(lambda: list(treescan.scan_tree(base_path, j)), runs)
+        print('%-24s %8.1fms %8d' % ('scan_tree (%d jobs)' % j, t * 1000, n))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
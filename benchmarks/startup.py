@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+"""\
+Measure the startup cost of git_ssh_server.py for each command.
+
+USAGE: %prog [-n RUNS] [command ...]
+
+Each command is run RUNS times (default 20) in a fresh interpreter, against
+a scratch repository tree and with git replaced by /bin/true, so that only
+the server's own overhead is measured.  For every command, the median wall
+time and the number of modules loaded are printed, next to the cost of
+starting a bare interpreter.  Run this before and after changing imports in
+git_ssh_server.py to track the startup cost of the hot transport commands.
+"""
+
+from __future__ import print_function
+
+import sys, os
+import shutil
+import subprocess
+import tempfile
+import time
+
+SRC = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_COMMANDS = [
+        "git-upload-pack 'u/bench.git'",
+        "git-receive-pack 'u/bench.git'",
+        "list",
+        "help",
+        ]
+
+# Run in the child interpreter: dispatch one command and record how many
+# modules it needed.
+CHILD = """
+import sys
+sys.path.insert(0, %(src)r)
+import git_ssh_server as g
+g.config.update(base_path=%(base)r, git='/bin/true', index=None,
+        stats=None)
+rc = g.dispatch(['git_ssh_server.py', 'bench'], %(cmd)r)
+f = open(%(out)r, 'w')
+f.write('%%d\\n' %% len(sys.modules))
+f.close()
+"""
+
+
+def median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def measure(argv, runs, devnull):
+    times = []
+    for i in range(runs):
+        start = time.time()
+        subprocess.call(argv, stdout=devnull, stderr=devnull)
+        times.append(time.time() - start)
+    return median(times)
+
+
+def main(argv):
+    runs = 20
+    args = argv[1:]
+    if args[:1] == ['-n']:
+        runs = int(args[1])
+        args = args[2:]
+    commands = args or DEFAULT_COMMANDS
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        base = os.path.join(tmpdir, 'repos')
+        os.makedirs(os.path.join(base, 'u'))
+        subprocess.call(['git', 'init', '-q', '--bare',
+                         os.path.join(base, 'u', 'bench.git')])
+        out = os.path.join(tmpdir, 'modules')
+        devnull = open(os.devnull, 'w')
+
+        bare = measure([sys.executable, '-c', 'pass'], runs, devnull)
+        print('%-36s %9s %8s' % ('command', 'median', 'modules'))
+        print('%-36s %7.1fms %8s' % ('(bare interpreter)', bare * 1000, '-'))
+        for cmd in commands:
+            code = CHILD % {'src': SRC, 'base': base, 'cmd': cmd, 'out': out}
+            t = measure([sys.executable, '-c', code], runs, devnull)
+            try:
+                n = open(out).read().strip()
+                os.remove(out)
+            except IOError:
+                n = '?'
+            print('%-36s %7.1fms %8s' % (cmd, t * 1000, n))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
@@ -0,0 +1,171 @@
+"""
+Copy repositories using copy-on-write clones where the filesystem allows.
+
+On filesystems that support reflinks (e.g. btrfs, and XFS with
+reflink=1), `copytree()` clones each file with the FICLONE ioctl: the copy
+shares all data blocks with the original, so it takes almost no time or
+space no matter how big the repository is.  Elsewhere it falls back to an
+ordinary copy.
+
+`copy_repository()` copies a bare repository that may be in use: it copies
+everything but the object store first, and the objects last, so that every
+object named by the copied refs is present in the copy.  A repack of the
+source while its objects are being copied can still make objects disappear
+from under the copy (the old packs are deleted, and the new pack was not
+there yet when the directory was listed), so the objects are copied again
+until no pack came or went in the meantime.
+"""
+
+# Make Python 2 act like Python 3.
+from __future__ import with_statement, division
+__metaclass__ = type        # default to new-style classes
+
+import os
+import os.path
+import errno
+import fcntl
+import shutil
+import tempfile
+
+# From <linux/fs.h>: _IOW(0x94, 9, int)
+FICLONE = 0x40049409
+
+# How many times copy_repository() tries to copy the objects.
+COPY_ATTEMPTS = 3
+
+_supported = {}
+
+
+def reflink(src, dst):
+    """Make `dst` a copy-on-write clone of the file `src`.  Raises IOError
+    (or OSError) if the filesystem cannot do it."""
+    s = open(src, 'rb')
+    try:
+        d = open(dst, 'wb')
+        try:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+        except:
+            d.close()
+            os.remove(dst)
+            raise
+        d.close()
+    finally:
+        s.close()
+    shutil.copymode(src, dst)
+
+
+def supports_reflink(path):
+    """Return True if files in directory `path` can be reflinked.  The
+    answer is cached for the life of the process."""
+    path = os.path.abspath(path)
+    try:
+        return _supported[path]
+    except KeyError:
+        pass
+    fd, src = tempfile.mkstemp(dir=path, prefix='.reflink-probe-')
+    dst = src + '.copy'
+    try:
+        os.write(fd, 'x')
+        os.close(fd)
+        try:
+            reflink(src, dst)
+        except (IOError, OSError):
+            result = False
+        else:
+            result = True
+    finally:
+        for f in (src, dst):
+            try:
+                os.remove(f)
+            except OSError:
+                pass
+    _supported[path] = result
+    return result
+
+
+def copytree(src, dst, copy=reflink, exclude=(), missing=None):
+    """Recursively copy directory `src` to `dst` (which must not exist),
+    copying each regular file with the function `copy`.  Names in `exclude`
+    are skipped at every level, as are lock files; entries of `exclude`
+    with a slash, e.g. "info/web/last-modified", are paths relative to
+    `src`.  Files that disappear before they can be copied are skipped, and
+    appended to the list `missing` if it is given.  If the copy fails,
+    `dst` is removed."""
+    try:
+        _copytree(src, dst, copy, exclude, missing, '')
+    except:
+        shutil.rmtree(dst, ignore_errors=True)
+        raise
+
+
+def _copytree(src, dst, copy, exclude, missing, prefix):
+    os.mkdir(dst)
+    for name in os.listdir(src):
+        if (name in exclude or prefix + name in exclude
+                or name.endswith('.lock')):
+            continue
+        s = os.path.join(src, name)
+        d = os.path.join(dst, name)
+        if os.path.islink(s):
+            os.symlink(os.readlink(s), d)
+        elif os.path.isdir(s):
+            _copytree(s, d, copy, exclude, missing, prefix + name + '/')
+        else:
+            try:
+                copy(s, d)
+            except (IOError, OSError), e:
+                # Files may come and go in a live repository (e.g. loose
+                # refs, or packs replaced by a repack).
+                if e.errno != errno.ENOENT:
+                    raise
+                if missing is not None:
+                    missing.append(s)
+    shutil.copystat(src, dst)
+
+
+def _is_object_file(path):
+    """Return True if `path` is a pack, pack index, or loose object (as
+    opposed to, e.g., a temporary file)."""
+    dirname, name = os.path.split(path)
+    if name.endswith(('.pack', '.idx')):
+        return True
+    return len(os.path.basename(dirname)) == 2 and len(name) == 38
+
+
+def _packs(repo):
+    try:
+        names = os.listdir(os.path.join(repo, 'objects', 'pack'))
+    except OSError:
+        return set()
+    return set(name for name in names if name.endswith('.pack'))
+
+
+def copy_repository(src, dst, copy=None, exclude=()):
+    """Copy the bare repository `src` to `dst`, the object store last.  If
+    `copy` is None, files are reflinked if the filesystem supports it and
+    copied otherwise.  Returns True on success, or False, after removing
+    `dst`, if `src` was repacked during every attempt to copy its objects;
+    the caller should then copy it some other way (e.g. git clone)."""
+    if copy is None:
+        if supports_reflink(os.path.dirname(os.path.abspath(dst))):
+            copy = reflink
+        else:
+            copy = shutil.copy2
+    exclude = tuple(exclude)
+    copytree(src, dst, copy, exclude + ('objects',))
+    objects = os.path.join(dst, 'objects')
+    try:
+        for i in range(COPY_ATTEMPTS):
+            before = _packs(src)
+            missing = []
+            copytree(os.path.join(src, 'objects'), objects, copy, exclude,
+                    missing)
+            if (not [path for path in missing if _is_object_file(path)]
+                    and _packs(src) == before):
+                return True
+            shutil.rmtree(objects)
+    except:
+        shutil.rmtree(dst, ignore_errors=True)
+        raise
+    shutil.rmtree(dst)
+    return False
@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+"""\
+Move the objects shared by each fork network into a common pool repository.
+
+USAGE: %prog [options] base_path pool_path
+
+A fork network is a set of repositories that share history: repositories
+that share a root commit, or that borrow objects from one another (see
+forks.py).  For every network with at least two members, this program
+maintains a pool repository "pool_path/ID.git" that holds the union of the
+members' objects:
+
+ 1. every member's refs are fetched into the pool, under
+    "refs/members/MEMBER-ID/", and the pool is repacked;
+ 2. the pool is added to each member's alternates;
+ 3. each member is repacked with --local, which drops every object that
+    the pool already has.
+
+After that, the history shared by a network is stored, and cached by the
+kernel, only once.  The pool never prunes objects.  Run this periodically
+(e.g. nightly from cron) so that new forks and new pushes get deduplicated.
+
+Every member's refs form a separate delta island in the pool (see "DELTA
+ISLANDS" in git-pack-objects(1)), and the pool is repacked with them.  A
+delta stored in the pool then never has a base that is unreachable from the
+member it belongs to, so fetches from any member can reuse the on-disk
+deltas instead of computing new ones.  git_ssh_server.py adds new forks of a
+pooled repository to the pool right away (see `join_network()`).
+"""
+
+# Make Python 2 act like Python 3.
+from __future__ import with_statement, division
+__metaclass__ = type        # default to new-style classes
+
+import sys, os
+import os.path
+import hashlib
+import optparse
+import subprocess
+import forks
+from repoindex import scan
+
+MEMBERS_FILE = 'members'
+MEMBER_REFS = 'refs/members'
+
+# Each member's refs are one island, named by the member id.
+ISLAND_CONFIG = [
+        ('pack.island', '^%s/([0-9a-f]+)/' % MEMBER_REFS),
+        ('repack.useDeltaIslands', 'true'),
+        ('gc.pruneExpire', 'never'),
+        ]
+
+
+def member_id(relpath):
+    """Return the stable identifier of the member at `relpath` in its
+    pool."""
+    return hashlib.sha1(relpath).hexdigest()[:16]
+
+
+def pool_of(pool_path, repo):
+    """Return the pool repository under `pool_path` that `repo` borrows
+    objects from, or None."""
+    pool_base = os.path.join(os.path.abspath(pool_path), '')
+    for path in forks.alternates(repo):
+        if path.startswith(pool_base):
+            return os.path.dirname(path)
+    return None
+
+
+def configure_pool(git, pool):
+    """Set up the delta islands and pruning policy of `pool`.  `git` is the
+    path to the git executable.  Returns the exit status of git."""
+    for key, value in ISLAND_CONFIG:
+        rc = subprocess.call([git, '--git-dir=%s' % pool, 'config',
+                '--replace-all', key, value])
+        if rc != 0:
+            return rc
+    return 0
+
+
+def add_member(git, pool, relpath, repo):
+    """Fetch the refs of `repo` (at `relpath` under the base path) into
+    their island in `pool`.  Returns the exit status of git."""
+    refspec = '+refs/*:%s/%s/*' % (MEMBER_REFS, member_id(relpath))
+    return subprocess.call([git, '--git-dir=%s' % pool, 'fetch', '--quiet',
+            '--no-tags', os.path.abspath(repo), refspec])
+
+
+def join_network(git, pool_path, parent, relpath, repo):
+    """Add the new fork `repo` (at `relpath` under the base path) of
+    `parent` to its parent's pool, if it has one: the fork borrows from the
+    pool, and gets its own delta island there right away.  Returns the exit
+    status of git, or 0 if the parent is not pooled."""
+    pool = pool_of(pool_path, parent)
+    if pool is None:
+        return 0
+    pool_objects = forks.objects_dir(pool)
+    paths = forks.alternates(repo)
+    if pool_objects not in paths:
+        forks.set_alternates(repo, [pool_objects] + paths)
+    rc = configure_pool(git, pool)
+    if rc == 0:
+        rc = add_member(git, pool, relpath, repo)
+    if rc == 0:
+        fd = os.open(os.path.join(pool, MEMBERS_FILE),
+                os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+        try:
+            os.write(fd, '%s %s\n' % (member_id(relpath), relpath))
+        finally:
+            os.close(fd)
+    return rc
+
+
+class _UnionFind:
+
+    def __init__(self):
+        self.parent = {}
+
+    def find(self, x):
+        self.parent.setdefault(x, x)
+        while self.parent[x] != x:
+            self.parent[x] = self.parent[self.parent[x]]
+            x = self.parent[x]
+        return x
+
+    def union(self, a, b):
+        a, b = self.find(a), self.find(b)
+        if a != b:
+            self.parent[max(a, b)] = min(a, b)
+
+
+class Pooler:
+
+    def __init__(self, base_path, pool_path, git='git', verbose=False):
+        self.base_path = base_path
+        self.pool_path = pool_path
+        self.git = git
+        self.verbose = verbose
+
+    def log(self, msg):
+        if self.verbose:
+            print >>sys.stderr, msg
+
+    def _git(self, repo, *args, **kwargs):
+        command = [self.git, '--git-dir=%s' % repo] + list(args)
+        if kwargs.get('output'):
+            p = subprocess.Popen(command, stdout=subprocess.PIPE)
+            out = p.communicate()[0]
+            if p.returncode != 0:
+                return None
+            return out
+        return subprocess.call(command, stdin=kwargs.get('stdin'))
+
+    def _realpath(self, relpath):
+        return os.path.join(self.base_path, relpath)
+
+    def pool_of(self, repo):
+        """Return the pool repository that `repo` already uses, or None."""
+        return pool_of(self.pool_path, repo)
+
+    def networks(self):
+        """Return a list of fork networks, each a sorted list of relative
+        repository paths, with at least two members each."""
+        uf = _UnionFind()
+        root_owner = {}
+        pool_owner = {}
+        for relpath in scan(self.base_path):
+            repo = self._realpath(relpath)
+            uf.find(relpath)
+            out = self._git(repo, 'rev-list', '--max-parents=0', '--all',
+                    output=True) or ''
+            for root in out.split():
+                if root in root_owner:
+                    uf.union(relpath, root_owner[root])
+                else:
+                    root_owner[root] = relpath
+            for child in forks.children(repo):
+                uf.union(relpath, child)
+            pool = self.pool_of(repo)
+            if pool is not None:
+                if pool in pool_owner:
+                    uf.union(relpath, pool_owner[pool])
+                else:
+                    pool_owner[pool] = relpath
+        groups = {}
+        for relpath in uf.parent:
+            if os.path.isdir(self._realpath(relpath)):
+                groups.setdefault(uf.find(relpath), []).append(relpath)
+        return sorted(sorted(g) for g in groups.values() if len(g) > 1)
+
+    def _choose_pool(self, members):
+        for relpath in members:
+            pool = self.pool_of(self._realpath(relpath))
+            if pool is not None:
+                return pool
+        name = hashlib.sha1(members[0]).hexdigest()[:16] + '.git'
+        return os.path.join(os.path.abspath(self.pool_path), name)
+
+    def init_pool(self, pool):
+        if not os.path.isdir(pool):
+            os.makedirs(pool)
+            rc = self._git(pool, 'init', '--bare', '--quiet')
+            if rc != 0:
+                return rc
+        return configure_pool(self.git, pool)
+
+    def _write_members(self, pool, members):
+        filename = os.path.join(pool, MEMBERS_FILE)
+        f = open(filename + '.tmp', 'w')
+        try:
+            for relpath in members:
+                f.write('%s %s\n' % (member_id(relpath), relpath))
+        finally:
+            f.close()
+        os.rename(filename + '.tmp', filename)
+
+    def _drop_stale_refs(self, pool, members):
+        """Delete the refs of repositories that left the network; their
+        objects stay in the pool, since other members may depend on
+        them."""
+        keep = set(member_id(m) for m in members)
+        out = self._git(pool, 'for-each-ref', '--format=%(refname)',
+                MEMBER_REFS, output=True) or ''
+        stale = [ref for ref in out.split()
+                 if ref.split('/')[2] not in keep]
+        if not stale:
+            return
+        p = subprocess.Popen([self.git, '--git-dir=%s' % pool, 'update-ref',
+                '--stdin'], stdin=subprocess.PIPE)
+        p.communicate(''.join('delete %s\n' % ref for ref in stale))
+
+    def pool_repack_args(self, recompute=False):
+        """Return the arguments for repacking a pool.  If `recompute`,
+        throw away the existing deltas, which may cross island boundaries;
+        that is only needed the first time islands are used."""
+        args = ['repack', '-a', '-d', '-q', '-i', '--keep-unreachable']
+        if recompute:
+            args.append('-f')
+        return args
+
+    def has_islands(self, pool):
+        out = self._git(pool, 'config', '--get', 'repack.useDeltaIslands',
+                output=True)
+        return out is not None and out.strip() == 'true'
+
+    def needs_repack(self, repo):
+        """Return True if `repo` has loose objects or more than one pack."""
+        out = self._git(repo, 'count-objects', '-v', output=True)
+        if out is None:
+            return True
+        stats = dict(line.split(': ', 1) for line in out.splitlines()
+                     if ': ' in line)
+        return int(stats.get('count', 0)) > 0 or int(stats.get('packs', 0)) > 1
+
+    def deduplicate(self, members):
+        """Pool the objects of one fork network."""
+        pool = self._choose_pool(members)
+        self.log('%s: %s' % (pool, ' '.join(members)))
+        recompute = os.path.isdir(pool) and not self.has_islands(pool)
+        if self.init_pool(pool) != 0:
+            return False
+        self._write_members(pool, members)
+        for relpath in members:
+            rc = add_member(self.git, pool, relpath, self._realpath(relpath))
+            if rc != 0:
+                self.log('%s: fetch failed' % relpath)
+                return False
+        self._drop_stale_refs(pool, members)
+        if self._git(pool, *self.pool_repack_args(recompute)) != 0:
+            return False
+
+        pool_objects = forks.objects_dir(pool)
+        for relpath in members:
+            repo = self._realpath(relpath)
+            paths = forks.alternates(repo)
+            new = pool_objects not in paths
+            if new:
+                # Keep the existing alternates: a push made since the fetch
+                # above may have borrowed objects from them.
+                forks.set_alternates(repo, [pool_objects] + paths)
+            if new or self.needs_repack(repo):
+                repack = ['repack', '-a', '-d', '-l', '-q']
+                if forks.has_children(repo):
+                    repack.append('--keep-unreachable')
+                if self._git(repo, *repack) != 0:
+                    self.log('%s: repack failed' % relpath)
+        return True
+
+    def run(self):
+        ok = True
+        for members in self.networks():
+            ok = self.deduplicate(members) and ok
+        return ok
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options] base_path '
+            'pool_path')
+    parser.add_option('--git', default='git',
+            help='path to the git executable [%default]')
+    parser.add_option('-n', '--dry-run', action='store_true',
+            help='only print the fork networks that were found')
+    parser.add_option('-v', '--verbose', action='store_true')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.error('expected a base path and a pool path')
+    pooler = Pooler(args[0], args[1], git=options.git,
+            verbose=options.verbose)
+    if options.dry_run:
+        for members in pooler.networks():
+            print ' '.join(members)
+        return 0
+    return 0 if pooler.run() else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,208 @@
+#!/usr/bin/env python
+"""\
+Bookkeeping for forks that share objects with their parent.
+
+USAGE: %prog [options] detach base_path repo
+
+A fork made in 'alternates' mode has no objects of its own at first; its
+"objects/info/alternates" file points at the parent's object directory, and
+the parent lists the fork (by its path relative to the base path) in a file
+named FORKS_FILE at the top of the parent repository.  The functions here
+keep both sides consistent when either repository is renamed, and turn a
+fork back into a self-contained repository when its parent is going away.
+
+Any objects a fork depends on must never be pruned from the parent, so the
+parent's "gc.pruneExpire" is set to "never" and maintenance.py repacks it
+with --keep-unreachable.
+
+Run this module as a script with "detach" before deleting the repository
+`repo` (a path relative to `base_path`): every fork of `repo` gets its own
+copy of the objects it borrows, after which `repo` can be removed.
+"""
+
+# Make Python 2 act like Python 3.
+from __future__ import with_statement, division
+__metaclass__ = type        # default to new-style classes
+
+import sys, os
+import os.path
+import optparse
+import subprocess
+from atomicfile import LockedAtomicFile
+
+FORKS_FILE = 'forks'
+
+
+def objects_dir(repo):
+    return os.path.join(os.path.abspath(repo), 'objects')
+
+
+def _alternates_file(repo):
+    return os.path.join(repo, 'objects', 'info', 'alternates')
+
+
+def alternates(repo):
+    """Return the list of object directories that `repo` borrows from."""
+    try:
+        f = open(_alternates_file(repo))
+    except IOError:
+        return []
+    try:
+        return [os.path.normpath(line.strip()) for line in f if line.strip()]
+    finally:
+        f.close()
+
+
+def set_alternates(repo, paths):
+    """Atomically replace the alternates of `repo` with `paths` (removing the
+    file if `paths` is empty)."""
+    filename = _alternates_file(repo)
+    if not paths:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        return
+    tmpfilename = filename + '.tmp'
+    f = open(tmpfilename, 'w')
+    try:
+        for path in paths:
+            f.write(path + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+    finally:
+        f.close()
+    os.rename(tmpfilename, filename)
+
+
+def children(repo):
+    """Return the forks recorded in `repo`, as paths relative to the base
+    path."""
+    try:
+        f = open(os.path.join(repo, FORKS_FILE))
+    except IOError:
+        return []
+    try:
+        return [line.strip() for line in f if line.strip()]
+    finally:
+        f.close()
+
+
+def has_children(repo):
+    return bool(children(repo))
+
+
+def _edit_children(repo, remove=None, add=None):
+    filename = os.path.join(repo, FORKS_FILE)
+    if not os.path.exists(filename):
+        if add is None:
+            return
+        open(filename, 'a').close()
+    with LockedAtomicFile(filename, autobreak=True) as f:
+        for line in f:
+            if line.strip() != remove:
+                f.write(line)
+        if add is not None:
+            f.write(add + '\n')
+        f.commit()
+
+
+def register(parent, child):
+    """Record that the repository at relative path `child` borrows objects
+    from the repository at `parent`."""
+    _edit_children(parent, add=child)
+
+
+def unregister(parent, child):
+    _edit_children(parent, remove=child)
+
+
+def parents(base_path, repo):
+    """Return the real paths of the repositories that `repo` borrows objects
+    from, excluding those outside of `base_path`."""
+    base = os.path.join(os.path.abspath(base_path), '')
+    out = []
+    for path in alternates(repo):
+        parent = os.path.dirname(path)
+        if parent.startswith(base):
+            out.append(parent)
+    return out
+
+
+def relocate(base_path, old, new):
+    """Fix up the fork records after the repository at real path `old` was
+    renamed to `new`."""
+    old_objects = objects_dir(old)
+    new_objects = objects_dir(new)
+    # Forks of the renamed repository must follow it...
+    for child in children(new):
+        child_path = os.path.join(base_path, child)
+        paths = alternates(child_path)
+        if old_objects in paths:
+            set_alternates(child_path, [new_objects if p == old_objects else p
+                                        for p in paths])
+    # ... and its own parent must know its new name.
+    old_rel = os.path.relpath(old, base_path)
+    new_rel = os.path.relpath(new, base_path)
+    for parent in parents(base_path, new):
+        if old_rel in children(parent):
+            unregister(parent, old_rel)
+            register(parent, new_rel)
+
+
+def dissociate(git, base_path, repo):
+    """Copy everything `repo` borrows into its own object store and stop
+    borrowing.  `git` is a function that runs git with the given arguments
+    and returns its exit status (e.g. `Backend.git`).  Returns that
+    status."""
+    rc = git('repack', '-a', '-d', '-q', git_dir=repo)
+    if rc != 0:
+        return rc
+    rel = os.path.relpath(repo, base_path)
+    for parent in parents(base_path, repo):
+        unregister(parent, rel)
+    set_alternates(repo, [])
+    return 0
+
+
+def detach_children(git, base_path, repo):
+    """Dissociate every fork of `repo`.  This must be done before `repo`
+    is deleted."""
+    for child in children(repo):
+        child_path = os.path.join(base_path, child)
+        if objects_dir(repo) in alternates(child_path):
+            rc = dissociate(git, base_path, child_path)
+            if rc != 0:
+                return rc
+    return 0
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options] detach base_path '
+            'repo')
+    parser.add_option('--git', default='git',
+            help='path to the git executable [%default]')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 3 or args[0] != 'detach':
+        parser.error("expected 'detach', a base path, and a repository")
+    base_path, repo = args[1:]
+    repo = os.path.join(base_path, repo)
+    if not os.path.isdir(repo):
+        parser.error("no such repository: '%s'" % repo)
+
+    def git(*args, **kwargs):
+        command = [options.git, '--git-dir=%s' % kwargs.pop('git_dir')]
+        return subprocess.call(command + list(args))
+
+    count = len(children(repo))
+    rc = detach_children(git, base_path, repo)
+    if rc != 0:
+        print >>sys.stderr, "Detaching failed (git exited with status %d)." \
+                % rc
+        return 1
+    print "Detached %d forks; the repository can now be deleted." % count
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
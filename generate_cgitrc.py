@@ -1,6 +1,29 @@
 #!/usr/bin/env python
+"""\
+Generate a cgit configuration file listing every repository.
+
+USAGE: %prog [--incremental] [--sharded] base_path outfile
+
+Write an entry for every repository under `base_path` to `outfile` (or
+standard output if it is "-").  With --incremental, the directory and
+description mtimes of every repository are kept in "outfile.state", only
+the entries of repositories that changed are rendered again, and `outfile`
+is left untouched if its contents would not change, so the job is cheap
+enough to run every few seconds.
+
+With --sharded, the entries of each owner ("u/USER", "g/GROUP", or
+"p/PROJECT") go to their own file, "outfile.d/u/USER.cgitrc" and so on,
+and `outfile` only includes those files.  A shard is rewritten only when
+its contents change, and shards of owners that no longer have any
+repositories are removed.
+"""
 
 import os, os.path, sys
+import json
+from treescan import scan_tree, DEFAULT_JOBS
+
+STATE_EXT = '.state'
+SHARDS_EXT = '.d'
 
 
 def owner_of(url):
@@ -16,35 +39,222 @@ def owner_of(url):
         owner = 'g/' + owner
     return owner
 
-def generate_cgitrc(base_path, outfile):
-    base_path = os.path.join(base_path, '')     # append a slash
-    base_len = len(base_path)
-    for root, dirs, files in os.walk(base_path):
-        if root.endswith('.git'):
-            dirs[:] = []        # descend no further
-            url = root[base_len:]
-            outfile.write('\nrepo.url=%s\n' % url)
-            outfile.write('repo.owner=%s\n' % owner_of(url))
-            if 'description' in files:
-                filename = os.path.join(root, 'description')
-                try:
-                    f = open(filename)
-                    desc = f.readline().strip()
-                    f.close()
-                except IOError:
-                    pass
-                else:
-                    outfile.write('repo.desc=%s\n' % desc)
-
-
-def main(base_path, outfilename):
-    if outfilename == '-':
-        generate_cgitrc(base_path, sys.stdout)
+def shard_of(url):
+    """Return the owner namespace of `url`, e.g. "u/mark" for both
+    "u/mark.git" and "u/mark/foo.git"."""
+    c = url.split('/')
+    owner = c[1]
+    if owner.endswith('.git'):
+        owner = owner[:-4]
+    return c[0] + '/' + owner
+
+def render(base_path, url):
+    """Return the cgitrc entry of the repository at `url`."""
+    out = ['\nrepo.url=%s\n' % url, 'repo.owner=%s\n' % owner_of(url)]
+    filename = os.path.join(base_path, url, 'description')
+    try:
+        f = open(filename)
+        desc = f.readline().strip()
+        f.close()
+    except IOError:
+        pass
+    else:
+        out.append('repo.desc=%s\n' % desc)
+    return ''.join(out)
+
+def generate_cgitrc(base_path, outfile, jobs=DEFAULT_JOBS):
+    for url in scan_tree(base_path, jobs):
+        outfile.write(render(base_path, url))
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+def _read(filename):
+    try:
+        f = open(filename)
+    except IOError:
+        return None
+    try:
+        return f.read()
+    finally:
+        f.close()
+
+def _write(filename, data):
+    tmpfilename = filename + '.tmp'
+    f = open(tmpfilename, 'w')
+    try:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    except:
+        f.close()
+        os.remove(tmpfilename)
+        raise
+    f.close()
+    os.rename(tmpfilename, filename)
+
+def _update(filename, data):
+    """Write `data` to `filename` unless it already holds it.  Returns True
+    if the file was written."""
+    if data == _read(filename):
+        return False
+    _write(filename, data)
+    return True
+
+# The entries are byte strings (descriptions need not even be UTF-8), so the
+# state stores them decoded as latin-1, which maps every byte to one
+# character and back.  A state in any other format is discarded.
+STATE_VERSION = 2
+
+def _load_state(statefilename):
+    try:
+        data = json.loads(_read(statefilename) or '{}')
+    except ValueError:
+        return {}
+    if not isinstance(data, dict) or data.get('version') != STATE_VERSION:
+        return {}
+    state = {}
+    for url, (mtime, desc_mtime, entry) in data['repos'].iteritems():
+        state[url.encode('latin-1')] = [mtime, desc_mtime,
+                                      entry.encode('latin-1')]
+    return state
+
+def _save_state(statefilename, state):
+    _write(statefilename, json.dumps({'version' : STATE_VERSION,
+                                      'repos' : state}, encoding='latin-1'))
+
+def _state_entry(base_path, url, cached=None):
+    """Return the state of `url`: the mtimes of its directory and its
+    description, and its entry, which is taken from the old state `cached`
+    if the mtimes have not changed."""
+    path = os.path.join(base_path, url)
+    key = [_mtime(path), _mtime(os.path.join(path, 'description'))]
+    if cached is not None and cached[:2] == key:
+        return key + [cached[2]]
+    return key + [render(base_path, url)]
+
+def render_cached(base_path, statefilename, jobs=DEFAULT_JOBS):
+    """Return a list of (url, entry) for every repository, re-rendering
+    only those whose directory or description changed since the state was
+    saved in `statefilename`."""
+    old = _load_state(statefilename)
+    new = {}
+    out = []
+    for url in scan_tree(base_path, jobs):
+        new[url] = _state_entry(base_path, url, old.get(url))
+        out.append((url, new[url][2]))
+    if new != old:
+        _save_state(statefilename, new)
+    return out
+
+def generate_incremental(base_path, outfilename, jobs=DEFAULT_JOBS):
+    """Bring `outfilename` up to date, re-rendering only the repositories
+    that changed.  Returns True if the file was rewritten."""
+    entries = render_cached(base_path, outfilename + STATE_EXT, jobs)
+    return _update(outfilename, ''.join(entry for url, entry in entries))
+
+def _shard_filename(outfilename, shard):
+    return os.path.join(os.path.abspath(outfilename + SHARDS_EXT),
+            shard + '.cgitrc')
+
+def _write_shard(filename, entries):
+    if not os.path.isdir(os.path.dirname(filename)):
+        os.makedirs(os.path.dirname(filename))
+    return _update(filename, ''.join(entries))
+
+def _write_includes(outfilename, shards):
+    return _update(outfilename, ''.join('include=%s\n'
+            % _shard_filename(outfilename, shard) for shard in sorted(shards)))
+
+def _group(entries):
+    """Return a dictionary mapping each shard to the list of its entries."""
+    shards = {}
+    for url, entry in entries:
+        shards.setdefault(shard_of(url), []).append(entry)
+    return shards
+
+def generate_sharded(base_path, outfilename, jobs=DEFAULT_JOBS,
+                     incremental=False):
+    """Write one file per owner and make `outfilename` include them all.
+    Returns the number of files written."""
+    if incremental:
+        entries = render_cached(base_path, outfilename + STATE_EXT, jobs)
+    else:
+        entries = [(url, render(base_path, url))
+                   for url in scan_tree(base_path, jobs)]
+    shards = _group(entries)
+    written = 0
+    for shard, data in shards.iteritems():
+        if _write_shard(_shard_filename(outfilename, shard), data):
+            written += 1
+    if _write_includes(outfilename, shards):
+        written += 1
+
+    # Remove the shards of owners that are gone, after nothing includes
+    # them any more.
+    keep = set(_shard_filename(outfilename, shard) for shard in shards)
+    for root, dirs, files in os.walk(os.path.abspath(outfilename
+                                                     + SHARDS_EXT)):
+        for name in files:
+            filename = os.path.join(root, name)
+            if filename not in keep:
+                os.remove(filename)
+    return written
+
+def apply_changes(base_path, outfilename, added, removed, sharded=False):
+    """Bring `outfilename`, last generated with --incremental (and
+    --sharded, if `sharded`), up to date after the repositories `added` and
+    `removed` (lists of urls) appeared and disappeared, without scanning
+    the tree: only those entries are rendered, and only their shards are
+    rewritten.  Returns the number of files written."""
+    statefilename = outfilename + STATE_EXT
+    state = _load_state(statefilename)
+    for url in removed:
+        state.pop(url, None)
+    for url in added:
+        state[url] = _state_entry(base_path, url)
+    _save_state(statefilename, state)
+    # Sorting the urls gives the same order as scan_tree().
+    entries = [(url, state[url][2]) for url in sorted(state)]
+    if not sharded:
+        return int(_update(outfilename,
+                           ''.join(entry for url, entry in entries)))
+
+    shards = _group(entries)
+    changed = set(shard_of(url) for url in list(added) + list(removed))
+    written = 0
+    for shard in changed:
+        if shard in shards and _write_shard(
+                _shard_filename(outfilename, shard), shards[shard]):
+            written += 1
+    if _write_includes(outfilename, shards):
+        written += 1
+    for shard in changed:
+        if shard not in shards:
+            try:
+                os.remove(_shard_filename(outfilename, shard))
+            except OSError:
+                pass
+    return written
+
+
+def main(base_path, outfilename, jobs=DEFAULT_JOBS, incremental=False,
+         sharded=False):
+    if sharded and outfilename != '-':
+        generate_sharded(base_path, outfilename, jobs, incremental)
+    elif incremental and outfilename != '-':
+        generate_incremental(base_path, outfilename, jobs)
+    elif outfilename == '-':
+        generate_cgitrc(base_path, sys.stdout, jobs)
     else:
         tmpfilename = outfilename + '.tmp'
         f = open(tmpfilename, 'w')
         try:
-            generate_cgitrc(base_path, f)
+            generate_cgitrc(base_path, f, jobs)
         except:
             f.close()
             os.remove(tmpfilename)
@@ -57,10 +267,13 @@ def main(base_path, outfilename):
 
 
 if __name__ == "__main__":
-    try:
-        base_path, outfilename = sys.argv[1:]
-    except ValueError:
-        print >>sys.stderr, __module__.__doc__
+    args = sys.argv[1:]
+    options = set()
+    while args and args[0] in ('--incremental', '--sharded'):
+        options.add(args.pop(0))
+    if len(args) != 2:
+        print >>sys.stderr, __doc__.replace('%prog',
+                os.path.basename(sys.argv[0]))
         sys.exit(1)
-    main(base_path, outfilename)
-
+    main(args[0], args[1], incremental='--incremental' in options,
+         sharded='--sharded' in options)
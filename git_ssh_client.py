@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+"""\
+Forward an SSH session to a running git_ssh_server.py daemon.
+
+USAGE: SSH_ORIGINAL_COMMAND='cmd' %prog user
+
+Use this in place of git_ssh_server.py in ~/.ssh/authorized_keys once the
+daemon has been started with "git_ssh_server.py --daemon".  It hands its
+standard input, output, and error over to the daemon, so the daemon talks to
+the SSH client directly, and exits with the status of the command.  If the
+daemon is not running, git_ssh_server.py is run directly instead.
+
+This program is deliberately tiny, so that it starts as fast as possible.
+"""
+
+import sys, os
+import socket
+
+# Must match config['daemon_socket'] in git_ssh_server.py.
+SOCKET = './git_ssh_server.sock'
+
+# Must match Daemon.ENVIRONMENT in git_ssh_server.py.
+ENVIRONMENT = ('GIT_PROTOCOL',)
+
+
+def fallback():
+    server = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+            'git_ssh_server.py')
+    os.execv(server, [server] + sys.argv[1:])
+
+
+def main(argv, cmd):
+    argv = [a for a in argv if a != '-c']
+    if len(argv) != 2 or not cmd:
+        fallback()
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(SOCKET)
+    except socket.error:
+        fallback()
+    from _multiprocessing import sendfd
+    for fd in (0, 1, 2):
+        sendfd(sock.fileno(), fd)
+    fields = [argv[1], cmd]
+    for name in ENVIRONMENT:
+        if name in os.environ:
+            fields.append('%s=%s' % (name, os.environ[name]))
+    sock.sendall('\0'.join(fields) + '\0\0')
+    status = ''
+    while not status.endswith('\n'):
+        chunk = sock.recv(64)
+        if not chunk:
+            return 1
+        status += chunk
+    return int(status)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv, os.environ.get('SSH_ORIGINAL_COMMAND')))
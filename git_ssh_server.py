@@ -23,17 +23,14 @@
 from __future__ import with_statement, division
 __metaclass__ = type        # default to new-style classes
 
+# Only the modules needed to serve git-upload-pack and git-receive-pack are
+# imported here; everything else is imported where it is used, so that the
+# transport commands start as quickly as possible.  See benchmarks/startup.py.
 import sys, os
-import textwrap
-import shlex
+import time
 import re
 import os.path
-import contextlib
-import subprocess
-try:
-    from odict import OrderedDict
-except ImportError:
-    OrderedDict = dict
+import errno
 
 class Error (Exception): pass
 class ArgumentError (Error): pass
@@ -47,14 +44,180 @@ config = {
         'base_path' : './repos',
         'git'       : '/usr/local/bin/git',
         'template'  : './template',
+        'index'     : './repos.index',
+        'daemon_socket' : './git_ssh_server.sock',
+
+        # The number of threads that walk the tree to find repositories
+        # when there is no index (see treescan.py).
+        'scan_jobs' : 8,
+
+        # If true, git-upload-pack and git-receive-pack replace the server
+        # process with git (see Backend.handoff) instead of running it as a
+        # child.  If `pre_exec` is set, it is called with the command (a
+        # list) just before the exec, e.g. to set resource limits.
+        'exec_git'  : False,
+        'pre_exec'  : None,
+
+        # If set, the directory in which packs generated by git-upload-pack
+        # are cached (see pack_cache.py), and the maximum size of the cache
+        # in bytes.
+        'pack_cache' : None,
+        'pack_cache_size' : 1 << 30,
+
+        # If set, the state directory of maintenance.py, in which every push
+        # is recorded so that the busiest repositories get maintained first.
+        'maintenance_dir' : None,
+
+        # If set, the time of the last push to each repository is written to
+        # this file in the repository, which should be cgit's `agefile`
+        # (cgit's default is 'info/web/last-modified'), so that cgit need not
+        # look at the refs to find each repository's idle time.  `list`
+        # reads it too (see Backend.last_push).
+        'agefile' : None,
+
+        # If set, a summary of each repository (see repometa.py) is kept in
+        # this file in the repository (e.g. 'info/metadata.json') and
+        # refreshed after every push, create, and fork, so that `show` need
+        # not run git.  Otherwise `show` computes the summary every time.
+        'metadata' : None,
+        # If set, the size and activity of every repository are also kept in
+        # this one file (e.g. './repos.stats'), from which `list --long`
+        # reads them.
+        'stats' : None,
+
+        # If `admission_dir` is set, limit the number of concurrent
+        # git-upload-pack and git-receive-pack sessions, in total, per user,
+        # and per repository (0 means no limit); see admission.py.  Sessions
+        # over the limit wait in line.
+        'admission_dir' : None,
+        'max_sessions' : 0,
+        'max_sessions_per_user' : 0,
+        'max_sessions_per_repo' : 0,
+
+        # How `fork` copies a repository: 'mirror' makes a full, independent
+        # copy; 'alternates' shares the parent's objects (see forks.py);
+        # 'reflink' makes a copy-on-write copy of the parent's files if the
+        # filesystem supports it (see cowcopy.py), and falls back to 'mirror'
+        # otherwise.
+        'fork_mode' : 'mirror',
+
+        # The fork mode of `fork --recursive`; None means `fork_mode`.
+        # Even 'mirror' shares objects at first, since git hard-links them
+        # when cloning within a filesystem; 'alternates' and 'reflink' keep
+        # sharing them.
+        'recursive_fork_mode' : None,
+
+        # How `create` makes a repository: 'init' runs git init; 'snapshot'
+        # reflinks or hard-links a prebuilt empty repository, which is kept
+        # in `snapshot_dir` (on the same filesystem as `base_path`) and
+        # rebuilt whenever `template` changes (see snapshot.py).
+        'create_mode' : 'init',
+        'snapshot_dir' : './snapshots',
+
+        # The maximum number of operations that `bulk` runs at once.
+        'bulk_jobs' : 4,
+
+        # The directory of fork-network pools maintained by forkpool.py.
+        # New forks of a pooled repository join its pool immediately.
+        'pool_path' : None,
         }
 
 
+class MembershipIndex:
+    """
+    A process-wide cache of group membership.
+
+    Each group's members file ("g/GROUP/.config/members") is parsed once and
+    kept in memory as a set, so checking membership is a dictionary lookup.
+    The file's mtime is checked at most once every `RECHECK` seconds per
+    group, and the file is re-read only if the mtime has changed.  Only the
+    group -> members direction is indexed; nothing needs a user's groups.
+
+    Use `get()` to obtain the instance shared by every `Backend` in the
+    process.
+    """
+
+    RECHECK = 1.0
+    _instances = {}
+
+    @classmethod
+    def get(cls, base_path, project_dir):
+        key = (base_path, project_dir)
+        try:
+            return cls._instances[key]
+        except KeyError:
+            index = cls._instances[key] = cls(base_path, project_dir)
+            return index
+
+    def __init__(self, base_path, project_dir):
+        self.group_path = os.path.join(base_path, 'g')
+        self.project_dir = project_dir
+        self._groups = {}       # group -> (mtime, last check, members)
+
+    def members(self, group):
+        """Return the set of users in `group` (empty if no such group)."""
+        now = time.time()
+        cached = self._groups.get(group)
+        if cached is not None and now - cached[1] < self.RECHECK:
+            return cached[2]
+        membersfile = os.path.join(self.group_path, group, self.project_dir,
+                'members')
+        try:
+            mtime = os.stat(membersfile).st_mtime
+        except OSError:
+            # No such group
+            mtime = None
+        if cached is not None and cached[0] == mtime:
+            members = cached[2]
+        elif mtime is None:
+            members = frozenset()
+        else:
+            try:
+                f = open(membersfile, 'r')
+            except IOError:
+                members = frozenset()
+            else:
+                try:
+                    members = frozenset(line.strip() for line in f
+                                        if line.strip())
+                finally:
+                    f.close()
+        self._groups[group] = (mtime, now, members)
+        return members
+
+    def is_member(self, user, group):
+        """Return True if `user` is a member of `group`."""
+        return user in self.members(group)
+
+
 class Backend:
 
     def __init__(self, user, config):
         self.user = user
         self.config = config
+        self.members = MembershipIndex.get(config['base_path'],
+                config['project_dir'])
+        # While `bulk` runs, the paths of new repositories, which are added
+        # to the index all at once at the end.
+        self.pending_index = None
+
+
+    @property
+    def index(self):
+        """The shared `RepositoryIndex`, or None if it is disabled."""
+        if not self.config.get('index'):
+            return None
+        from repoindex import RepositoryIndex
+        return RepositoryIndex.get(self.config['index'])
+
+    @property
+    def stats(self):
+        """The shared `repometa.RepositoryStats`, or None if it is
+        disabled."""
+        if not self.config.get('stats'):
+            return None
+        from repometa import RepositoryStats
+        return RepositoryStats.get(self.config['stats'])
 
 
     # Internal commands:
@@ -126,27 +289,45 @@ class Backend:
         elif prefix == 'p':
             return True
         elif prefix == 'g':
-            membersfile = os.path.join(self.config['base_path'], prefix, base,
-                    self.config['project_dir'], 'members')
-            try:
-                f = open(membersfile, 'r')
-            except IOError:
-                # No such group
-                return False
-            try:
-                for line in f:
-                    if line.strip() == token:
-                        return True
-            finally:
-                f.close()
-            return False
+            return self.members.is_member(self.user, base)
         else:
             raise ValueError("undefined prefix: `%s'" % prefix)
 
+    def relative_path(self, realpath):
+        """Return the path of `realpath` relative to the base path, as
+        stored in the repository index."""
+        return os.path.relpath(realpath, self.config['base_path'])
+
     def run(self, *command, **kwargs):
+        import subprocess
+        # Keep our output in order with the child's (e.g. in `batch`).
+        sys.stdout.flush()
         return subprocess.call(command, **kwargs)
 
-    def git(self, *args, **kwargs):
+    def handoff(self, *command):
+        """Run `command` as the last thing this process does.
+
+        If ``config['exec_git']`` is true, the process is replaced by
+        `command` (after calling ``config['pre_exec']``, if set), so no
+        Python process stays around for the duration of a transfer; this
+        method then never returns.  Otherwise it is the same as `run()`.
+        """
+        if not self.config.get('exec_git'):
+            return self.run(*command)
+        command = list(command)
+        pre_exec = self.config.get('pre_exec')
+        if pre_exec is not None:
+            pre_exec(command)
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.execv(command[0], command)
+
+    def git_command(self, *args, **kwargs):
+        """Return the command line that runs git with the given arguments.
+
+        Keyword arguments become long options: ``git_dir='x'`` becomes
+        ``--git-dir=x``, and a value of True becomes a bare flag.
+        """
         args = list(args)
         for k,v in kwargs.iteritems():
             k = k.replace('_','-')      # git uses -'s, python uses _'s
@@ -158,76 +339,529 @@ class Backend:
                 args.insert(0, v)
             else:
                 args.append(v)
-        return self.run(self.config['git'], *args)
+        return [self.config['git']] + args
+
+    def git(self, *args, **kwargs):
+        return self.run(*self.git_command(*args, **kwargs))
+
+    def admit(self, path):
+        """Wait for a free transfer slot for the repository at `path`.
+        Returns the `admission.Ticket` (or None if admission control is
+        disabled); the slot is held until the ticket is released or the
+        process exits."""
+        state_dir = self.config.get('admission_dir')
+        if not state_dir:
+            return None
+        import admission
+        control = admission.AdmissionControl(state_dir, {
+                'global' : self.config.get('max_sessions'),
+                'user' : self.config.get('max_sessions_per_user'),
+                'repo' : self.config.get('max_sessions_per_repo'),
+                })
+        return control.acquire(self.user, path)
+
+    def after_push_needed(self):
+        """Return True if `after_push()` has anything to do, in which case
+        git-receive-pack must not be exec'ed."""
+        return bool(self.config.get('pack_cache')
+                    or self.config.get('maintenance_dir')
+                    or self.config.get('agefile')
+                    or self.keeps_metadata())
+
+    def ref_state(self, path):
+        """Return the refs of the repository at `path` (a real path) as a
+        string, to tell whether a push changed anything: rejected pushes and
+        pushes of nothing new must not count as activity."""
+        import subprocess
+        p = subprocess.Popen(self.git_command("for-each-ref",
+                "--format=%(objectname) %(refname)", git_dir=path),
+                stdout=subprocess.PIPE)
+        return p.communicate()[0]
+
+    def after_push(self, path):
+        """Update derived state after a successful push that changed the
+        refs of the repository at `path` (a real path, as returned by
+        `transform_path()`)."""
+        if self.config.get('pack_cache'):
+            import pack_cache
+            pack_cache.invalidate(self.config['pack_cache'], path)
+        if self.config.get('maintenance_dir'):
+            import maintenance
+            maintenance.record_push(self.config['maintenance_dir'], path)
+        if self.config.get('agefile'):
+            self.record_push_time(path)
+        if self.keeps_metadata():
+            self.refresh_metadata(path)
+
+    def refresh_metadata(self, path, record=None):
+        """Recompute and store the summary of the repository at `path` (a
+        real path), or store `record` if it is given.  Returns the
+        summary."""
+        import repometa
+        if record is None:
+            record = repometa.collect(self.config['git'], path,
+                    self.last_push(self.relative_path(path)))
+        if self.config.get('metadata'):
+            repometa.write(path, self.config['metadata'], record)
+        if self.stats is not None:
+            self.stats.record(self.relative_path(path), record)
+        return record
+
+    def keeps_metadata(self):
+        return bool(self.config.get('metadata') or self.config.get('stats'))
+
+    def metadata(self, path):
+        """Return the summary of the repository at `path` (a real path),
+        computing it only if it was never stored.  The statistics file is
+        left alone, since this is only a read."""
+        import repometa
+        if self.config.get('metadata'):
+            record = repometa.read(path, self.config['metadata'])
+            if record is not None:
+                return record
+        record = repometa.collect(self.config['git'], path,
+                self.last_push(self.relative_path(path)))
+        if self.config.get('metadata'):
+            repometa.write(path, self.config['metadata'], record)
+        return record
+
+    def record_push_time(self, path, when=None):
+        """Write the time of a push (default: now) to the agefile of the
+        repository at `path`, in a format that cgit understands.  The file's
+        mtime is the same time, which is what `last_push()` reads."""
+        if when is None:
+            when = time.time()
+        filename = os.path.join(path, self.config['agefile'])
+        dirname = os.path.dirname(filename)
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        tmpfilename = '%s.%d.tmp' % (filename, os.getpid())
+        f = open(tmpfilename, 'w')
+        try:
+            f.write(time.strftime('%Y-%m-%d %H:%M:%S +0000\n',
+                    time.gmtime(when)))
+        finally:
+            f.close()
+        os.utime(tmpfilename, (when, when))
+        os.rename(tmpfilename, filename)
+
+    def last_push(self, relpath):
+        """Return the time of the last push to the repository at `relpath`
+        (relative to the base path), or None if it is not known."""
+        agefile = self.config.get('agefile')
+        if not agefile:
+            return None
+        try:
+            return os.stat(os.path.join(self.config['base_path'], relpath,
+                    agefile)).st_mtime
+        except OSError:
+            return None
 
 
     # External commands:
 
     def git_upload_pack(self, path):
         path = self.transform_path(path, write=False)
-        return self.git("upload-pack", path)
+        ticket = self.admit(path)
+        args = ["upload-pack", path]
+        cache_dir = self.config.get('pack_cache')
+        if cache_dir:
+            import pack_cache
+            hook = os.path.abspath(pack_cache.__file__)
+            if hook.endswith(('.pyc', '.pyo')):
+                hook = hook[:-1]
+            os.environ[pack_cache.ENV_DIR] = os.path.abspath(cache_dir)
+            os.environ[pack_cache.ENV_SIZE] = str(
+                    self.config['pack_cache_size'])
+            # git only honors this option on the command line or in the
+            # system or global configuration, never in the repository.
+            args[:0] = ["-c", "uploadpack.packObjectsHook=%s %s"
+                    % (sys.executable, hook)]
+        # If git is exec'ed, it inherits the slots and holds them until it
+        # exits; otherwise they are released once it is done.
+        try:
+            return self.handoff(*self.git_command(*args))
+        finally:
+            if ticket is not None:
+                ticket.release()
 
 
     def git_receive_pack(self, path):
         path = self.transform_path(path)
-        return self.git("receive-pack", path)
+        ticket = self.admit(path)
+        command = self.git_command("receive-pack", path)
+        if not self.after_push_needed():
+            try:
+                return self.handoff(*command)
+            finally:
+                if ticket is not None:
+                    ticket.release()
+        before = self.ref_state(path)
+        try:
+            rc = self.run(*command)
+        finally:
+            # The work after the push needs no transfer slot.
+            if ticket is not None:
+                ticket.release()
+        if self.ref_state(path) != before:
+            if rc == 0:
+                self.after_push(path)
+            elif self.config.get('pack_cache'):
+                # Some refs may have been updated before the failure.
+                import pack_cache
+                pack_cache.invalidate(self.config['pack_cache'], path)
+        return rc
+
 
+    def _makeparent(self, path):
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError, e:
+                # `bulk` may be creating a sibling at the same time.
+                if e.errno != errno.EEXIST:
+                    raise
+
+    def _index_add(self, realpath):
+        if self.index is None:
+            return
+        if self.pending_index is not None:
+            self.pending_index.append(self.relative_path(realpath))
+        else:
+            self.index.add(self.relative_path(realpath))
 
     def create(self, path):
+        mode = self.config.get('create_mode', 'init')
+        if mode not in ('init', 'snapshot'):
+            raise ValueError("undefined create mode: `%s'" % mode)
         path = self.transform_path(path, existing=False)
-        os.makedirs(path)
-        return self.git("init", bare=True, quiet=True, git_dir=path,
-                template=self.config['template'])
+        self._makeparent(path)
+        if mode == 'snapshot':
+            from snapshot import Snapshot
+            snapshot = Snapshot(self.config['snapshot_dir'],
+                    self.config['template'], self.git)
+            done = snapshot.materialize(path)
+        else:
+            done = False
+        if done:
+            rc = 0
+        else:
+            os.mkdir(path)
+            rc = self.git("init", bare=True, quiet=True, git_dir=path,
+                    template=self.config['template'])
+        if rc == 0:
+            self._index_add(path)
+            if self.keeps_metadata():
+                import repometa
+                self.refresh_metadata(path, repometa.empty(path))
+        return rc
 
 
-    def fork(self, old, new):
+    def fork(self, old, new, mode=None):
+        """Fork repository `old` to `new`, using fork mode `mode` (default:
+        ``config['fork_mode']``)."""
+        if mode is None:
+            mode = self.config.get('fork_mode', 'mirror')
+        if mode not in ('mirror', 'alternates', 'reflink'):
+            raise ValueError("undefined fork mode: `%s'" % mode)
         old = self.transform_path(old, write=False)
         new = self.transform_path(new, existing=False)
-        os.makedirs(new)
-        return self.git("clone", old, new, bare=True, quiet=True, mirror=True,
-                template=self.config['template'])
+        if mode == 'reflink':
+            import cowcopy
+            if not cowcopy.supports_reflink(self.config['base_path']):
+                mode = 'mirror'
+        if mode == 'reflink':
+            import forks
+            self._makeparent(new)
+            # The parent's forks, last push, and summary are not the new
+            # repository's.
+            exclude = [forks.FORKS_FILE]
+            for key in ('agefile', 'metadata'):
+                if self.config.get(key):
+                    exclude.append(self.config[key])
+            if cowcopy.copy_repository(old, new, cowcopy.reflink,
+                    exclude=exclude):
+                rc = 0
+            else:
+                # The parent kept being repacked while its objects were
+                # copied; let git make a consistent copy instead.
+                mode = 'mirror'
+        if mode == 'alternates':
+            import forks
+            os.makedirs(new)
+            rc = self.git("clone", os.path.abspath(old), new, bare=True,
+                    quiet=True, mirror=True, shared=True,
+                    template=self.config['template'])
+            if rc == 0:
+                forks.set_alternates(new, [forks.objects_dir(old)])
+                forks.register(old, self.relative_path(new))
+                # The fork depends on objects that the parent might one day
+                # consider unreachable.
+                self.git("config", "gc.pruneExpire", "never", git_dir=old)
+        elif mode == 'mirror':
+            import forks
+            os.makedirs(new)
+            rc = self.git("clone", old, new, bare=True, quiet=True,
+                    mirror=True, template=self.config['template'])
+        if rc == 0 and mode != 'alternates':
+            # If the parent borrows objects, so does the copy.
+            for parent in forks.parents(self.config['base_path'], new):
+                forks.register(parent, self.relative_path(new))
+        if rc == 0 and self.config.get('pool_path'):
+            import forkpool
+            forkpool.join_network(self.config['git'], self.config['pool_path'],
+                    old, self.relative_path(new), new)
+        if rc == 0:
+            self._index_add(new)
+            if self.keeps_metadata():
+                self.refresh_metadata(new)
+        return rc
+
+
+    def bulk_plan(self, operations):
+        """Check a list of operations for `bulk`, each a tuple ('create',
+        path) or ('fork', old, new), without running any.
+
+        Returns (`waves`, `errors`).  `waves` is a list of lists of indexes
+        into `operations`; the operations in each wave may run in parallel,
+        once the previous waves are done (a fork of a repository created in
+        the same batch waits for the create).  `errors` is a list of
+        (index, message) for every invalid operation.
+        """
+        wave_of = {}        # operation index -> wave
+        made_by = {}        # path -> index of the operation that makes it
+        errors = []
+        for i, op in enumerate(operations):
+            try:
+                if op[0] == 'create' and len(op) == 2:
+                    sources, target = [], op[1]
+                elif op[0] == 'fork' and len(op) == 3:
+                    sources, target = [op[1]], op[2]
+                else:
+                    raise InvalidPath("expected 'create <path>' or "
+                            "'fork <existing_path> <new_path>'")
+                wave = 0
+                for source in sources:
+                    source = source.strip('/')
+                    if source in made_by:
+                        self.transform_path(source, existing=False,
+                                write=False)
+                        wave = max(wave, wave_of[made_by[source]] + 1)
+                    else:
+                        self.transform_path(source, write=False)
+                target = target.strip('/')
+                self.transform_path(target, existing=False)
+                if target in made_by:
+                    raise InvalidPath("Repository '%s' is already made by "
+                            "operation %d" % (target, made_by[target] + 1))
+            except Error, e:
+                errors.append((i, str(e)))
+                continue
+            made_by[target] = i
+            wave_of[i] = wave
+        waves = []
+        for i in sorted(wave_of):
+            while len(waves) <= wave_of[i]:
+                waves.append([])
+            waves[wave_of[i]].append(i)
+        return waves, errors
+
+    def bulk(self, operations, waves, jobs=None, report=None, fork_mode=None):
+        """Run `operations` in the order given by `waves` (both as checked
+        by `bulk_plan`), with at most `jobs` (default:
+        ``config['bulk_jobs']``) at a time, forking with `fork_mode` (see
+        `fork`).  `report`, if given, is called with the index of each
+        operation and its result as soon as it finishes.  The result is
+        None on success and an error message otherwise.  Returns the list
+        of results."""
+        if jobs is None:
+            jobs = self.config.get('bulk_jobs', 4)
+        import threading
+        import Queue
+        results = [None] * len(operations)
+        failed = set()
+        lock = threading.Lock()
+
+        def perform(i):
+            op = operations[i]
+            if op[0] == 'fork' and op[1].strip('/') in failed:
+                return "'%s' was not created" % op[1]
+            try:
+                if op[0] == 'create':
+                    rc = self.create(op[1])
+                else:
+                    rc = self.fork(op[1], op[2], fork_mode)
+            except Exception, e:
+                return str(e) or type(e).__name__
+            if rc != 0:
+                return 'git failed (status %d)' % rc
+            return None
+
+        def worker(queue):
+            while True:
+                try:
+                    i = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                result = perform(i)
+                with lock:
+                    results[i] = result
+                    if result is not None:
+                        failed.add(operations[i][-1].strip('/'))
+                    if report is not None:
+                        report(i, result)
+
+        self.pending_index = []
+        try:
+            for wave in waves:
+                queue = Queue.Queue()
+                for i in wave:
+                    queue.put(i)
+                threads = [threading.Thread(target=worker, args=(queue,))
+                           for n in range(max(1, min(jobs, len(wave))))]
+                for t in threads:
+                    t.start()
+                for t in threads:
+                    t.join()
+        finally:
+            pending, self.pending_index = self.pending_index, None
+            if pending and self.index is not None:
+                self.index.update(add=pending)
+        return results
+
+
+    def show(self, path):
+        """Return the summary (see repometa.py) of repository `path`."""
+        return self.metadata(self.transform_path(path, write=False))
+
+    def stats_table(self):
+        """Return a dictionary mapping repository paths to their cached
+        statistics (see `repometa.stats_of()`)."""
+        if self.stats is None:
+            return {}
+        return self.stats.table()
+
+
+    def fork_tree(self, old, new):
+        """Return the list of operations (for `bulk`) that fork every
+        repository the user can read under directory `old` to the same
+        place under directory `new`."""
+        old = old.strip('/')
+        new = new.strip('/')
+        for path in (old, new):
+            if not path or path.endswith('.git'):
+                raise InvalidPath("'%s' is not a directory of repositories"
+                        % path)
+        return [('fork', path, new + path[len(old):])
+                for path in self.list(pattern='^%s/' % re.escape(old))]
 
 
     def rename(self, old, new):
         old = self.transform_path(old)
         new = self.transform_path(new, existing=False)
         os.rename(old, new)
-
-
-    def list(self, pattern=None, write=False, mine=False):
-        r = re.compile(pattern) if pattern else None
-        out = []
-        base_path = self.config['base_path']
+        import forks
+        forks.relocate(self.config['base_path'], old, new)
+        if self.index is not None:
+            self.index.rename(self.relative_path(old), self.relative_path(new))
+        if self.stats is not None:
+            self.stats.rename(self.relative_path(old), self.relative_path(new))
+
+
+    def list(self, pattern=None, write=False, mine=False, after=None,
+             pushed_since=None):
+        """Yield the paths of the repositories the user may see, in sorted
+        order, as they are found.  If `after` is given, start with the first
+        path that sorts after it.  If `pushed_since` is given, only yield
+        repositories pushed to at or after that time."""
+        from repoindex import search
         operation = 'write' if write or mine else 'read'
-        for root, dirs, files in os.walk(base_path):
-            if root.endswith('.git'):
-                dirs[:] = []
-                path = root[len(base_path)+1:]
-                if r is not None and not r.search(path):
-                    continue
-                prefix, base = path.split('/')[:2]
-                if base.endswith('.git'):
-                    base = base[:-4]
-                if mine and prefix == 'p':
-                    continue
-                try:
-                    self.validate(path, operation, prefix, base)
-                except PermissionError:
+        if self.index is not None and self.index.exists():
+            paths = self.index.paths()
+        else:
+            from treescan import scan_tree
+            from repoindex import literal_hints
+            # Only walk the subtrees that can match an anchored pattern.
+            prefix = literal_hints(pattern)[0] if pattern else None
+            paths = scan_tree(self.config['base_path'],
+                    self.config.get('scan_jobs', 8), after, prefix)
+        paths = search(paths, pattern or None, after)
+        for path in paths:
+            prefix, base = path.split('/')[:2]
+            if base.endswith('.git'):
+                base = base[:-4]
+            if mine and prefix == 'p':
+                continue
+            try:
+                self.validate(path, operation, prefix, base)
+            except PermissionError:
+                continue
+            if pushed_since is not None:
+                when = self.last_push(path)
+                if when is None or when < pushed_since:
                     continue
-                out.append(path)
-        return out
+            yield path
 
 
 
+def _format_size(size):
+    """Format a number of bytes for people, e.g. '1.5 MiB'."""
+    if size < 1024:
+        return '%d B' % size
+    for unit in ('KiB', 'MiB', 'GiB', 'TiB'):
+        size /= 1024
+        if size < 1024 or unit == 'TiB':
+            return '%.1f %s' % (size, unit)
+
+
+def _format_age(seconds):
+    """Format a duration for people, e.g. '3h' or '12d'."""
+    seconds = max(0, seconds)
+    for limit, unit, name in ((3600, 60, 'm'), (2 * 86400, 3600, 'h'),
+                              (365 * 86400, 86400, 'd')):
+        if seconds < limit:
+            return '%d%s' % (seconds // unit, name)
+    return '%dy' % (seconds // (365 * 86400))
+
+
+class _CommandTable:
+    """
+    A class attribute holding the ordered table of commands.
+
+    The `OrderedDict` is built on first access, so that dispatching a
+    transport command never has to import odict.
+    """
+
+    def __init__(self, command_list):
+        self.command_list = command_list
+        self.table = None
+
+    def __get__(self, obj, cls=None):
+        if self.table is None:
+            try:
+                from odict import OrderedDict
+            except ImportError:
+                OrderedDict = dict
+            self.table = OrderedDict(self.command_list)
+        return self.table
+
+
 class Frontend:
 
     def __init__(self, backend):
         self.backend = backend
+        # False while running `batch`, whose standard input holds commands
+        # rather than answers.
+        self.interactive = True
 
 
-    @staticmethod
-    def _confirm(prompt=None, default=False):
-        """Present a confirmation to the user on standard output."""
+    def _confirm(self, prompt=None, default=False):
+        """Present a confirmation to the user on standard output.  When not
+        interactive, the answer is always yes."""
+
+        if not self.interactive:
+            return True
 
         answers = {
                 'y' : True,
@@ -262,6 +896,7 @@ class Frontend:
         lines = doc.split('\n')
         first = lines.pop(0)
         rest = '\n'.join(lines)
+        import textwrap
         formatted = '\n'.join((first, textwrap.dedent(rest)))
         return formatted.strip()
 
@@ -353,46 +988,186 @@ class Frontend:
         """
         List available repositories.
 
-        USAGE: list [--mine|--writable] [[--] pattern]
+        USAGE: list [--mine|--writable] [--active=DAYS] [--long] [--sort=KEY] [--json] [--limit=N] [--after=PATH] [[--] pattern]
 
-        List all available repositories.  If the regular expression `pattern`
-        is given, only return repositories that match.
+        List all available repositories, in sorted order.  If the regular
+        expression `pattern` is given, only return repositories that match.
 
         Options:
-            --writable  only list repositories you can write to
-            --mine      only list repositories you own
+            --writable    only list repositories you can write to
+            --mine        only list repositories you own
+            --active=DAYS only list repositories pushed to in the last DAYS
+                          days
+            --long        also print the size of each repository and the
+                          time since its last push (or commit)
+            --sort=KEY    sort by KEY: 'name' (the default), 'size' (largest
+                          first), or 'age' (least recently active first)
+            --json        print one JSON object per line, with the path and
+                          the time of the last push ("last_push", in
+                          seconds since the epoch, or null); with --long,
+                          also "size", "branches", "tags", and
+                          "last_active"
+            --limit=N     print at most N repositories
+            --after=PATH  start after repository PATH
+
+        Results are printed as they are found, unless sorted by size or age.
+        If --limit cuts the list short, the last line (on standard error, or
+        a JSON object with a "next" key) gives the PATH to pass to --after
+        for the next page; when sorted by size or age there are no further
+        pages, and only "(more)" is printed.  Sizes and times come from statistics cached when
+        each repository was last pushed to; "-" means none are known.
         """
         args.pop(0)
-        mine = write = False
-        pattern = None
-        if args:
-            o = args[0]
-            if o.startswith('-'):
-                if o == '--mine':
-                    mine = True
-                elif o == '--writable':
-                    write = True
-                elif o == '--':
-                    pass
-                else:
-                    raise UsageError()
-                args.pop(0)
-        if args:
-            o = args[0]
-            if o.startswith('-'):
-                if o != '--':
-                    raise UsageError()
-                args.pop(0)
+        mine = write = json_output = long_output = False
+        pattern = after = limit = pushed_since = None
+        sort = 'name'
+        while args and args[0].startswith('-'):
+            o = args.pop(0)
+            if o == '--mine':
+                mine = True
+            elif o == '--writable':
+                write = True
+            elif o == '--json':
+                json_output = True
+            elif o == '--long':
+                long_output = True
+            elif o.startswith('--sort='):
+                sort = o[len('--sort='):]
+                if sort not in ('name', 'size', 'age'):
+                    raise UsageError("invalid sort key: '%s'" % sort)
+            elif o.startswith('--limit='):
+                try:
+                    limit = int(o[len('--limit='):])
+                except ValueError:
+                    raise UsageError("invalid limit: '%s'" % o)
+                if limit < 1:
+                    raise UsageError("invalid limit: '%s'" % o)
+            elif o.startswith('--after='):
+                after = o[len('--after='):].strip('/')
+            elif o.startswith('--active='):
+                try:
+                    days = float(o[len('--active='):])
+                except ValueError:
+                    raise UsageError("invalid number of days: '%s'" % o)
+                pushed_since = time.time() - days * 86400
+            elif o == '--':
+                break
+            else:
+                raise UsageError()
         if args:
             pattern = args.pop(0)
         if args:
             raise UsageError()
-        repos = self.backend.list(pattern=pattern, write=write, mine=mine)
-        if len(repos) == 0:
+        if sort != 'name' and after is not None:
+            raise UsageError("--after only works with --sort=name")
+        if json_output:
+            import json
+        repos = self.backend.list(pattern=pattern, write=write, mine=mine,
+                after=after, pushed_since=pushed_since)
+        stats = {}
+        if long_output or sort != 'name':
+            stats = self.backend.stats_table()
+        if sort == 'size':
+            repos = sorted(repos, key=lambda r:
+                    -(stats.get(r, {}).get('size') or 0))
+        elif sort == 'age':
+            repos = sorted(repos, key=lambda r:
+                    stats.get(r, {}).get('last_active') or 0)
+        now = time.time()
+        count = 0
+        last = None
+        for r in repos:
+            if limit is not None and count == limit:
+                # --after only works in name order, so there is no cursor
+                # to give for the other orders.
+                if sort != 'name':
+                    if not json_output:
+                        print >>sys.stderr, "(more)"
+                elif json_output:
+                    print json.dumps({'next' : last})
+                else:
+                    print >>sys.stderr, "(more; continue with --after=%s)" \
+                            % last
+                break
+            if json_output and long_output:
+                record = {'path' : r}
+                for key in ('size', 'branches', 'tags', 'last_push',
+                            'last_active'):
+                    record[key] = stats.get(r, {}).get(key)
+                print json.dumps(record)
+            elif json_output:
+                print json.dumps({'path' : r,
+                                  'last_push' : self.backend.last_push(r)})
+            elif long_output:
+                entry = stats.get(r, {})
+                size = entry.get('size')
+                active = entry.get('last_active')
+                print "%10s %6s  %s" % (
+                        '-' if size is None else _format_size(size),
+                        '-' if active is None else _format_age(now - active),
+                        r)
+            else:
+                print r
+            count += 1
+            last = r
+            if count % 100 == 1:
+                # Let the client see results while we keep looking.
+                sys.stdout.flush()
+        if count == 0 and not json_output:
             print "No repositories found."
+
+
+    def show(self, args):
+        """
+        Show information about a repository.
+
+        USAGE: show [--json] <path>
+
+        Print the default branch, the number of branches and tags, the size,
+        the last commit, and the time of the last push of a repository.
+        With --json, print them as a JSON object instead (see repometa.py
+        for its keys).
+        """
+        args.pop(0)
+        json_output = False
+        if args and args[0] == '--json':
+            json_output = True
+            args.pop(0)
+        if len(args) != 1:
+            raise UsageError()
+        record = self.backend.show(args[0])
+        if json_output:
+            import json
+            print json.dumps(record, sort_keys=True)
+            return 0
+
+        def when(t):
+            if t is None:
+                return 'never'
+            return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(t))
+
+        def text(s):
+            # A stored summary comes back from JSON as unicode, which
+            # cannot be printed to a pipe.
+            if isinstance(s, unicode):
+                return s.encode('utf-8')
+            return s
+
+        commit = record.get('last_commit')
+        if commit:
+            last_commit = '%s %s (%s, %s)' % (text(commit['id'][:7]),
+                    text(commit['subject']), text(commit['author']),
+                    when(commit['time']))
         else:
-            for r in repos:
-                print r
+            last_commit = '(none)'
+        print args[0].strip('/')
+        print "    HEAD:         %s" % text(record.get('head') or '(detached)')
+        print "    Branches:     %d" % record.get('branches', 0)
+        print "    Tags:         %d" % record.get('tags', 0)
+        print "    Size:         %s" % _format_size(record.get('size') or 0)
+        print "    Last commit:  %s" % last_commit
+        print "    Last push:    %s" % when(record.get('last_push'))
+        return 0
 
 
     def create(self, args):
@@ -453,16 +1228,207 @@ class Frontend:
 
         USAGE: fork <existing_path> <new_path>
 
+        USAGE: fork --recursive [--jobs=N] <existing_dir> <new_dir>
+
         Make a copy of an existing repository.  The new name must be valid;
         see "help create" for more information.
+
+        With --recursive, fork every repository that you can read under the
+        directory <existing_dir> to the same place under <new_dir>, up to N
+        at a time, e.g. "fork -r p/project g/team/project".  All of the new
+        names are checked before any fork is made.
         """
-        if len(args) != 3:
+        args.pop(0)
+        recursive = False
+        jobs = None
+        while args and args[0].startswith('-'):
+            o = args.pop(0)
+            if o in ('-r', '--recursive'):
+                recursive = True
+            elif o.startswith('--jobs='):
+                jobs = self._parse_jobs(o)
+            elif o == '--':
+                break
+            else:
+                raise UsageError()
+        if len(args) != 2:
             raise UsageError()
-        rc = self.backend.fork(args[1], args[2])
+        if recursive:
+            return self._fork_tree(args[0], args[1], jobs)
+        if jobs is not None:
+            raise UsageError("--jobs requires --recursive")
+        rc = self.backend.fork(args[0], args[1])
         if rc == 0:
-            print "Successfully forked '%s' to '%s'" % (args[1], args[2])
+            print "Successfully forked '%s' to '%s'" % (args[0], args[1])
         return rc
 
+    def _fork_tree(self, old, new, jobs):
+        operations = self.backend.fork_tree(old, new)
+        if not operations:
+            raise Error("No repositories found under '%s'" % old.strip('/'))
+        waves, invalid = self.backend.bulk_plan(operations)
+        if invalid:
+            for i, msg in invalid:
+                print >>sys.stderr, "%s: %s" % (operations[i][1], msg)
+            print >>sys.stderr, "No repositories were forked."
+            return 1
+        print "Forking %d repositories..." % len(operations)
+        return self._run_bulk(operations, waves, jobs,
+                self.backend.config.get('recursive_fork_mode'))
+
+
+    def bulk(self, args):
+        """
+        Create and fork many repositories at once.
+
+        USAGE: bulk [--jobs=N] < manifest
+
+        Read a manifest from standard input, with one operation per line:
+
+            create <path>
+            fork <existing_path> <new_path>
+
+        Blank lines and lines starting with '#' are ignored.  Every operation
+        is checked first, and if any is invalid, nothing is done.  Otherwise
+        up to N operations run at once, and a line is printed for each one
+        as it finishes.  A fork of a repository created in the same manifest
+        waits for the create.
+        """
+        jobs = None
+        for o in args[1:]:
+            if o.startswith('--jobs='):
+                jobs = self._parse_jobs(o)
+            else:
+                raise UsageError()
+
+        import shlex
+        operations = []
+        lines = []
+        errors = []
+        for n, line in enumerate(sys.stdin):
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            try:
+                operations.append(tuple(shlex.split(line)))
+                lines.append(n + 1)
+            except ValueError, e:
+                errors.append((n + 1, str(e)))
+        if not operations and not errors:
+            print "Nothing to do."
+            return 0
+
+        waves, invalid = self.backend.bulk_plan(operations)
+        for i, msg in invalid:
+            errors.append((lines[i], "%s: %s" % (' '.join(operations[i]),
+                    msg)))
+        if errors:
+            for n, msg in sorted(errors):
+                print >>sys.stderr, "line %d: %s" % (n, msg)
+            print >>sys.stderr, "No operations were run."
+            return 1
+
+        return self._run_bulk(operations, waves, jobs)
+
+    @staticmethod
+    def _parse_jobs(option):
+        try:
+            return int(option[len('--jobs='):])
+        except ValueError:
+            raise UsageError("invalid job count: '%s'" % option)
+
+    def _run_bulk(self, operations, waves, jobs=None, fork_mode=None):
+        """Run checked `bulk` operations, printing a line as each one
+        finishes and a summary at the end."""
+        limit = self.backend.config.get('bulk_jobs', 4)
+        if jobs is None:
+            jobs = limit
+        jobs = max(1, min(jobs, limit))
+        done = [0]
+
+        def report(i, result):
+            done[0] += 1
+            progress = '[%d/%d]' % (done[0], len(operations))
+            if result is None:
+                print "%s ok      %s" % (progress, ' '.join(operations[i]))
+            else:
+                print "%s FAILED  %s: %s" % (progress,
+                        ' '.join(operations[i]), result)
+            sys.stdout.flush()
+
+        results = self.backend.bulk(operations, waves, jobs, report,
+                fork_mode)
+        failed = len([r for r in results if r is not None])
+        print "%d succeeded, %d failed." % (len(results) - failed, failed)
+        return 1 if failed else 0
+
+
+    def batch(self, args):
+        """
+        Run many commands in one session.
+
+        USAGE: batch [--stop-on-error] < commands
+
+        Read commands from standard input, one per line, and run each as if
+        it were given on the ssh command line.  Blank lines and lines
+        starting with '#' are ignored.  The output of each command (standard
+        output and standard error) is followed by a line of the form
+
+            --- exit STATUS
+
+        Confirmations (e.g. by "rename") are answered yes.  The commands
+        batch, bulk, git-upload-pack, and git-receive-pack cannot be run
+        in a batch.  With --stop-on-error, stop after the first command that
+        fails.
+        """
+        stop_on_error = False
+        for o in args[1:]:
+            if o == '--stop-on-error':
+                stop_on_error = True
+            else:
+                raise UsageError()
+
+        # Frame everything, including git's messages, on standard output.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved_stderr = sys.stderr, os.dup(2)
+        os.dup2(1, 2)
+        sys.stderr = sys.stdout
+        self.interactive = False
+        failed = 0
+        try:
+            while True:
+                line = sys.stdin.readline()
+                if not line:
+                    break
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                # Check the name as it will be run, i.e. after unquoting.
+                cmd_args = self.parse(line)
+                if cmd_args is None:
+                    rc = 1
+                elif cmd_args[0] in self.batch_excluded:
+                    print >>sys.stderr, "ERROR: '%s' cannot be run in a " \
+                            "batch" % cmd_args[0]
+                    rc = 1
+                else:
+                    rc = self.execute(cmd_args)
+                print "--- exit %d" % rc
+                sys.stdout.flush()
+                if rc != 0:
+                    failed += 1
+                    if stop_on_error:
+                        break
+        finally:
+            self.interactive = True
+            sys.stderr, fd = saved_stderr
+            os.dup2(fd, 2)
+            os.close(fd)
+        return 1 if failed else 0
+
+    batch_excluded = ('batch', 'bulk', 'git-upload-pack', 'git-receive-pack')
+
 
     def unknown_command(self, args):
         """Called when a command is not found."""
@@ -470,12 +1436,15 @@ class Frontend:
                 % args[0])
 
 
-    commands = OrderedDict([
+    command_list = [
             ("help"             , help),
             ("list"             , list),
+            ("show"             , show),
             ("create"           , create),
             ("rename"           , rename),
             ("fork"             , fork),
+            ("bulk"             , bulk),
+            ("batch"            , batch),
             ("git-upload-pack"  , git_upload_pack),
             ("git-receive-pack" , git_receive_pack),
 
@@ -485,22 +1454,48 @@ class Frontend:
 
             # Ideas:
             #("config",          , config), # set project meta-data
-            #("show",            , show),   # project info
             #("cat",             , cat),    # cat file
             #("ls",              , ls),     # directory list
             #("find",            , find),   # like find command?
             #("follow",          , follow), # like github's follow
-            ])
+            ]
 
+    commands = _CommandTable(command_list)
 
-    def interpret(self, cmdline):
-        """Interpret the given command line."""
+    transport_RE = re.compile(r"^(git-upload-pack|git-receive-pack) "
+            r"('?)([^' ]+)\2$")
+
+
+    def parse(self, cmdline):
+        """Split the given command line into arguments.  Returns None, after
+        reporting the error, if it cannot be parsed."""
+        m = self.transport_RE.match(cmdline)
+        if m is not None:
+            # Fast path: git always sends "git-xxx-pack 'path'", which needs
+            # neither shlex nor the full command table.
+            return [m.group(1), m.group(3)]
+        import shlex
         try:
             args = shlex.split(cmdline)
         except ValueError, e:
             print >>sys.stderr, "Error parsing command line:", e
+            return None
+        if not args:
+            print >>sys.stderr, "Error parsing command line: no command"
+            return None
+        return args
+
+    def interpret(self, cmdline):
+        """Interpret the given command line."""
+        args = self.parse(cmdline)
+        if args is None:
+            return 1
+        return self.execute(args)
+
+    def execute(self, args):
+        """Run the command given as a list of arguments."""
         cmd = args[0]
-        f = self.commands.get(cmd, type(self).unknown_command)
+        f = dict(self.command_list).get(cmd, type(self).unknown_command)
         rc = 1
         try:
             rc = f(self, args)
@@ -523,6 +1518,241 @@ class Frontend:
 
 
 
+class Daemon:
+    """
+    A resident server that answers requests forwarded by git_ssh_client.py.
+
+    Starting a fresh interpreter and importing this module for every SSH
+    connection is a large share of the cost of a short request.  The daemon
+    instead does that work once, listens on the Unix socket named by
+    ``config['daemon_socket']``, and forks a child for every connection.  The
+    child inherits the warm interpreter and caches (e.g. the repository and
+    membership indexes), so it can dispatch immediately.
+
+    The client sends its standard input, output, and error file descriptors
+    (in that order) over the socket, followed by the user, the command, and
+    any forwarded environment variables, each terminated by a NUL byte and
+    the whole list by an extra NUL.  The child installs the file descriptors
+    as its own stdio and runs the command exactly as `main()` would.  When
+    the child exits, the daemon writes its exit status to the socket as a
+    decimal number followed by a newline, and closes the connection.
+    """
+
+    # Environment variables that the client may forward.
+    ENVIRONMENT = ('GIT_PROTOCOL',)
+
+    # Seconds a client has to send its whole request; requests are read one
+    # at a time, so a client that stalls holds up everyone else until then.
+    REQUEST_TIMEOUT = 5.0
+
+    def __init__(self, config):
+        self.config = config
+        self.path = config['daemon_socket']
+        self.children = {}      # pid -> connection
+        self.sock = None
+        self.wakeup = None      # (read end, write end) of the self-pipe
+
+    def listen(self):
+        import socket
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        old_umask = os.umask(077)
+        try:
+            self.sock.bind(self.path)
+        finally:
+            os.umask(old_umask)
+        self.sock.listen(128)
+
+    def _sigchld(self, signum, frame):
+        # Only wake up the main loop, which does the reaping: a handler
+        # that runs between fork() and the update of self.children would
+        # lose the child's status.
+        try:
+            os.write(self.wakeup[1], 'x')
+        except OSError:
+            pass
+
+    def reap(self):
+        """Collect exited children and report their status to the
+        clients."""
+        import socket
+        while True:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno == errno.ECHILD:
+                    return
+                raise
+            if pid == 0:
+                return
+            if os.WIFSIGNALED(status):
+                rc = 128 + os.WTERMSIG(status)
+            else:
+                rc = os.WEXITSTATUS(status)
+            conn = self.children.pop(pid, None)
+            if conn is None:
+                continue
+            try:
+                conn.sendall('%d\n' % rc)
+            except socket.error:
+                pass
+            conn.close()
+
+    def warm(self):
+        """Bring the caches shared with the children up to date."""
+        if self.config.get('index'):
+            from repoindex import RepositoryIndex
+            RepositoryIndex.get(self.config['index']).paths()
+
+    def preload(self):
+        """Import everything that is otherwise imported on first use, so
+        that no child has to."""
+        import textwrap, shlex, subprocess, repoindex
+        Frontend.commands
+
+    @staticmethod
+    def _retry(func, *args):
+        """Call `func`, restarting it if a signal interrupts it."""
+        while True:
+            try:
+                return func(*args)
+            except EnvironmentError, e:
+                if e.errno != errno.EINTR:
+                    raise
+
+    @classmethod
+    def _wait(cls, conn, deadline):
+        """Wait until `conn` is readable, raising Error at `deadline`.
+        (recvfd works on the raw descriptor, so a socket timeout would not
+        apply to it.)"""
+        import select
+        while True:
+            timeout = deadline - time.time()
+            if timeout <= 0:
+                raise Error("timed out reading the request")
+            try:
+                if select.select([conn], [], [], timeout)[0]:
+                    return
+            except select.error, e:
+                if e.args[0] != errno.EINTR:
+                    raise
+
+    @classmethod
+    def _read_request(cls, conn):
+        """Return (`fds`, `fields`) as sent by the client."""
+        from _multiprocessing import recvfd
+        deadline = time.time() + cls.REQUEST_TIMEOUT
+        fds = []
+        try:
+            for i in range(3):
+                cls._wait(conn, deadline)
+                fds.append(cls._retry(recvfd, conn.fileno()))
+            data = ''
+            while not data.endswith('\0\0'):
+                cls._wait(conn, deadline)
+                chunk = cls._retry(conn.recv, 4096)
+                if not chunk:
+                    raise Error("connection closed by client")
+                data += chunk
+        except:
+            # Don't leak the descriptors into the daemon and its children.
+            for fd in fds:
+                os.close(fd)
+            raise
+        return fds, data[:-2].split('\0')
+
+    def handle(self, conn):
+        import socket, signal
+        try:
+            fds, fields = self._read_request(conn)
+        except (Error, socket.error, OSError), e:
+            print >>sys.stderr, "bad request:", e
+            conn.close()
+            return
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid:
+            for fd in fds:
+                os.close(fd)
+            self.children[pid] = conn
+            return
+        # In the child: become the session described by the request.
+        rc = 1
+        try:
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            for fd in self.wakeup:
+                os.close(fd)
+            self.sock.close()
+            conn.close()
+            for c in self.children.values():
+                c.close()
+            for i, fd in enumerate(fds):
+                os.dup2(fd, i)
+                os.close(fd)
+            user, cmd = fields[:2]
+            for var in fields[2:]:
+                name, _, value = var.partition('=')
+                if name in self.ENVIRONMENT:
+                    os.environ[name] = value
+            os.environ['SSH_ORIGINAL_COMMAND'] = cmd
+            rc = dispatch([sys.argv[0], user], cmd)
+        except SystemExit, e:
+            rc = e.code
+        except:
+            import traceback
+            traceback.print_exc()
+        finally:
+            try:
+                sys.stdout.flush()
+                sys.stderr.flush()
+            finally:
+                os._exit(rc if isinstance(rc, int) else 1)
+
+    def serve_forever(self):
+        import socket, signal, select, fcntl
+        self.preload()
+        self.listen()
+        self.wakeup = os.pipe()
+        for fd in self.wakeup:
+            flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
+        signal.signal(signal.SIGCHLD, self._sigchld)
+        # Restart system calls interrupted by SIGCHLD rather than failing
+        # them with EINTR.
+        signal.siginterrupt(signal.SIGCHLD, False)
+        while True:
+            try:
+                ready = select.select([self.sock, self.wakeup[0]], [], [])[0]
+            except select.error, e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.wakeup[0] in ready:
+                try:
+                    while os.read(self.wakeup[0], 4096):
+                        pass
+                except OSError, e:
+                    if e.errno not in (errno.EAGAIN, errno.EINTR):
+                        raise
+                self.reap()
+            if self.sock in ready:
+                try:
+                    conn, addr = self.sock.accept()
+                except socket.error, e:
+                    if e.args[0] in (errno.EINTR, errno.EAGAIN):
+                        continue
+                    raise
+                self.warm()
+                self.handle(conn)
+
+
+
 def main(argv, cmd):
     # Remove '-c', which is set if this script is the user's default shell.
     argv = list(argv)
@@ -531,6 +1761,10 @@ def main(argv, cmd):
     except ValueError:
         pass
 
+    if len(argv) == 2 and argv[1] == '--daemon':
+        Daemon(config).serve_forever()
+        return
+
     if len(argv) != 2 or not cmd:
         raise ArgumentError("USAGE: SSH_ORIGINAL_COMMAND='cmd' %s user"
                 % argv[0])
@@ -538,16 +1772,21 @@ def main(argv, cmd):
     user = argv[1]
     b = Backend(user, config)
     f = Frontend(b)
-    f.interpret(cmd)
+    return f.interpret(cmd)
 
 
-if __name__ == "__main__":
+def dispatch(argv, cmd):
+    """Run `main()` and return the exit status, reporting errors the way a
+    command line user expects."""
     try:
-        rc = main(sys.argv, os.environ.get('SSH_ORIGINAL_COMMAND'))
+        rc = main(argv, cmd)
     except Error, e:
         print >>sys.stderr, e
-        sys.exit(1)
-    else:
-        if rc is None:
-            rc = 0
-        sys.exit(rc)
+        return 1
+    if rc is None:
+        rc = 0
+    return rc
+
+
+if __name__ == "__main__":
+    sys.exit(dispatch(sys.argv, os.environ.get('SSH_ORIGINAL_COMMAND')))
@@ -0,0 +1,284 @@
+#!/usr/bin/env python
+"""\
+Run background maintenance on the repositories that need it most.
+
+USAGE: %prog [options] state_dir
+
+git_ssh_server.py records every push in `state_dir` (when
+config['maintenance_dir'] is set).  Each run of this program folds the new
+pushes into a score for each repository, picks the repositories with the
+highest scores, and runs the maintenance tasks (pack-refs, a full repack
+with a reachability bitmap, and a commit-graph) on them, at most `--jobs`
+repositories at a time and at idle CPU and I/O priority.  The score of a
+repository is the number of pushes since it was last maintained plus the
+number of packs it has.
+
+Run it from cron every few minutes, or with --loop to keep it running.  A
+run that starts while another is still going exits at once, so the limit
+of `--jobs` holds across runs.
+"""
+
+# Make Python 2 act like Python 3.
+from __future__ import with_statement, division
+__metaclass__ = type        # default to new-style classes
+
+import sys, os
+import os.path
+import errno
+import fcntl
+import json
+import time
+import optparse
+import subprocess
+import threading
+import Queue
+from atomicfile import Lock
+import forks
+
+PUSH_LOG = 'pushes'
+SCORES = 'scores.json'
+LOCK = 'lock'
+# Held for the whole of a run, so that runs never overlap.
+RUN_LOCK = 'run.lock'
+
+# Prefixes that drop the priority of maintenance work; missing programs are
+# skipped.
+NICE = ['nice', '-n', '19']
+IONICE = ['ionice', '-c', '3']
+
+
+def record_push(state_dir, repo):
+    """Record a push to the repository at `repo`.  Safe to call from many
+    processes at once."""
+    line = os.path.abspath(repo) + '\n'
+    fd = os.open(os.path.join(state_dir, PUSH_LOG),
+            os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+    try:
+        os.write(fd, line)
+    finally:
+        os.close(fd)
+
+
+def count_packs(repo):
+    try:
+        names = os.listdir(os.path.join(repo, 'objects', 'pack'))
+    except OSError:
+        return 0
+    return len([n for n in names if n.endswith('.pack')])
+
+
+def _which(program):
+    for d in os.environ.get('PATH', '').split(os.pathsep):
+        if os.access(os.path.join(d, program), os.X_OK):
+            return True
+    return False
+
+
+class Scheduler:
+    """
+    Prioritize and run maintenance for the repositories recorded in
+    `state_dir`.
+
+    The state directory contains the append-only log of pushes written by
+    `record_push()` and a JSON file mapping each repository to its number of
+    pushes since the last maintenance and the time of that maintenance.
+    """
+
+    def __init__(self, state_dir, git='git', jobs=2, limit=50, threshold=2):
+        self.state_dir = state_dir
+        self.git = git
+        self.jobs = jobs
+        self.limit = limit
+        self.threshold = threshold
+        self.prefix = []
+        if _which(NICE[0]):
+            self.prefix += NICE
+        if _which(IONICE[0]):
+            self.prefix += IONICE
+
+    def _path(self, name):
+        return os.path.join(self.state_dir, name)
+
+    def load(self):
+        try:
+            f = open(self._path(SCORES))
+        except IOError:
+            return {}
+        try:
+            return json.load(f)
+        finally:
+            f.close()
+
+    def save(self, scores):
+        filename = self._path(SCORES)
+        tmpfilename = filename + '.tmp'
+        f = open(tmpfilename, 'w')
+        try:
+            json.dump(scores, f)
+            f.flush()
+            os.fsync(f.fileno())
+        finally:
+            f.close()
+        os.rename(tmpfilename, filename)
+
+    def collect(self, scores):
+        """Fold the pushes logged since the last run into `scores`."""
+        log = self._path(PUSH_LOG)
+        claimed = '%s.%d' % (log, os.getpid())
+        try:
+            os.rename(log, claimed)
+        except OSError:
+            return
+        f = open(claimed)
+        try:
+            for line in f:
+                repo = line.strip()
+                if repo:
+                    entry = scores.setdefault(repo, {'pushes' : 0,
+                                                     'maintained' : 0})
+                    entry['pushes'] += 1
+        finally:
+            f.close()
+        os.remove(claimed)
+
+    def select(self, scores):
+        """Return the repositories to maintain now, most urgent first."""
+        candidates = []
+        for repo, entry in scores.items():
+            if not os.path.isdir(repo):
+                del scores[repo]
+                continue
+            if not entry['pushes']:
+                continue
+            score = entry['pushes'] + count_packs(repo)
+            if score >= self.threshold:
+                candidates.append((score, repo))
+        candidates.sort(reverse=True)
+        return [repo for score, repo in candidates[:self.limit]]
+
+    def tasks(self, repo):
+        """Return the list of commands that maintain `repo`."""
+        git = [self.git, '--git-dir=%s' % repo]
+        repack = ['repack', '-a', '-d', '-l', '-b', '-q']
+        if forks.has_children(repo):
+            # Forks may still need objects that are unreachable here.
+            repack.append('--keep-unreachable')
+        return [
+                git + ['pack-refs', '--all', '--prune'],
+                git + repack,
+                git + ['commit-graph', 'write', '--reachable'],
+                ]
+
+    def maintain(self, repo):
+        """Run all maintenance tasks on `repo`; return True on success."""
+        devnull = open(os.devnull, 'w')
+        try:
+            for command in self.tasks(repo):
+                rc = subprocess.call(self.prefix + command, stdout=devnull)
+                if rc != 0:
+                    print >>sys.stderr, "%s: '%s' failed (status %d)" % (
+                            repo, ' '.join(command[2:]), rc)
+                    return False
+        finally:
+            devnull.close()
+        return True
+
+    def _lock_run(self):
+        """Take the run lock without waiting.  Returns the locked file
+        descriptor, or None if another run holds it.  The lock is flock(2)ed,
+        so it is dropped if a run dies."""
+        fd = os.open(self._path(RUN_LOCK), os.O_RDWR | os.O_CREAT, 0666)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError, e:
+            os.close(fd)
+            if e.errno in (errno.EAGAIN, errno.EACCES):
+                return None
+            raise
+        return fd
+
+    def run_once(self):
+        """Collect pushes and maintain the most urgent repositories, using
+        at most `jobs` workers.  Returns the number maintained.  If another
+        run is still going, does nothing and returns 0."""
+        run_lock = self._lock_run()
+        if run_lock is None:
+            return 0
+        try:
+            return self._run()
+        finally:
+            os.close(run_lock)
+
+    def _run(self):
+        with Lock(self._path(LOCK), autobreak=True):
+            scores = self.load()
+            self.collect(scores)
+            self.save(scores)
+            repos = self.select(scores)
+            pushes = dict((repo, scores[repo]['pushes']) for repo in repos)
+        if not repos:
+            return 0
+
+        queue = Queue.Queue()
+        for repo in repos:
+            queue.put(repo)
+        done = []
+
+        def worker():
+            while True:
+                try:
+                    repo = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                if self.maintain(repo):
+                    done.append((repo, time.time()))
+
+        threads = [threading.Thread(target=worker)
+                   for i in range(min(self.jobs, len(repos)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        with Lock(self._path(LOCK), autobreak=True):
+            scores = self.load()
+            self.collect(scores)
+            for repo, when in done:
+                entry = scores.get(repo)
+                if entry is not None:
+                    # Pushes that arrived during maintenance still count.
+                    entry['pushes'] = max(0, entry['pushes'] - pushes[repo])
+                    entry['maintained'] = when
+            self.save(scores)
+        return len(done)
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options] state_dir')
+    parser.add_option('-j', '--jobs', type='int', default=2,
+            help='number of repositories to maintain at once [%default]')
+    parser.add_option('-n', '--limit', type='int', default=50,
+            help='maximum number of repositories per run [%default]')
+    parser.add_option('-t', '--threshold', type='int', default=2,
+            help='minimum score that triggers maintenance [%default]')
+    parser.add_option('--git', default='git',
+            help='path to the git executable [%default]')
+    parser.add_option('--loop', type='float', metavar='SECONDS',
+            help='run forever, sleeping SECONDS between runs')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 1:
+        parser.error('expected exactly one state directory')
+    scheduler = Scheduler(args[0], git=options.git, jobs=options.jobs,
+            limit=options.limit, threshold=options.threshold)
+    while True:
+        scheduler.run_once()
+        if options.loop is None:
+            break
+        time.sleep(options.loop)
+
+
+if __name__ == "__main__":
+    try:
+        main(sys.argv)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,209 @@
+#!/usr/bin/env python
+"""\
+A cache of the packs generated by git-upload-pack.
+
+USAGE: %prog git pack-objects [options...]
+
+This program is meant to be used as git's uploadpack.packObjectsHook;
+git_ssh_server.py sets that up when config['pack_cache'] is set.  git runs
+it in place of "git pack-objects", with the same arguments and input.
+
+The cache key is the repository, the pack-objects options, and the
+want/have list read from standard input.  On a hit, the stored pack is
+streamed to the client without running pack-objects at all.  On a miss,
+pack-objects is run and its output is sent to the client and saved in the
+cache at the same time.  The total size of the cache is kept under a limit
+by evicting the least recently used packs.  All packs for a repository are
+dropped when it is pushed to (see `invalidate()`).
+
+The cache directory and size limit are passed in the environment variables
+named by ENV_DIR and ENV_SIZE.  If ENV_DIR is unset, the hook simply runs
+pack-objects.
+"""
+
+# Make Python 2 act like Python 3.
+from __future__ import with_statement, division
+__metaclass__ = type        # default to new-style classes
+
+import sys, os
+import os.path
+import errno
+import hashlib
+import shutil
+import subprocess
+import threading
+
+ENV_DIR = 'GIT_SSH_SERVER_PACK_CACHE'
+ENV_SIZE = 'GIT_SSH_SERVER_PACK_CACHE_SIZE'
+
+DEFAULT_SIZE = 1 << 30
+CHUNK_SIZE = 65536
+PACK_EXT = '.pack'
+
+# Options that affect only what is printed to stderr, not the pack itself.
+IGNORED_OPTIONS = ('--progress', '-q', '--all-progress',
+        '--all-progress-implied')
+
+
+def repository_key(repo):
+    """Return the name of the cache subdirectory for repository `repo`."""
+    return hashlib.sha1(os.path.realpath(repo)).hexdigest()
+
+
+def request_key(args, request):
+    """Return the cache key for pack-objects `args` and stdin `request`."""
+    h = hashlib.sha1()
+    for arg in args:
+        if arg not in IGNORED_OPTIONS:
+            h.update(arg + '\0')
+    h.update('\0')
+    h.update(request)
+    return h.hexdigest()
+
+
+def invalidate(cache_dir, repo):
+    """Drop every cached pack for repository `repo`."""
+    shutil.rmtree(os.path.join(cache_dir, repository_key(repo)),
+            ignore_errors=True)
+
+
+def evict(cache_dir, max_size):
+    """Remove the least recently used packs until the cache is no larger
+    than `max_size` bytes."""
+    entries = []
+    total = 0
+    for root, dirs, files in os.walk(cache_dir):
+        for name in files:
+            if not name.endswith(PACK_EXT):
+                continue
+            path = os.path.join(root, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+            total += st.st_size
+    entries.sort()
+    for mtime, size, path in entries:
+        if total <= max_size:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+
+def write_all(fd, data):
+    while data:
+        n = os.write(fd, data)
+        data = data[n:]
+
+
+def read_all(fd):
+    chunks = []
+    while True:
+        chunk = os.read(fd, CHUNK_SIZE)
+        if not chunk:
+            return ''.join(chunks)
+        chunks.append(chunk)
+
+
+def serve_hit(filename):
+    """Stream the cached pack `filename` to standard output and mark it as
+    recently used.  Returns False if there is no such entry."""
+    try:
+        f = open(filename, 'rb')
+    except IOError:
+        return False
+    try:
+        os.utime(filename, None)
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            write_all(1, chunk)
+    finally:
+        f.close()
+    return True
+
+
+def serve_miss(command, request, filename, max_size):
+    """Run `command` with `request` as its input, copying its output both to
+    standard output and to the cache entry `filename`.  Returns the exit
+    status of `command`."""
+    dirname = os.path.dirname(filename)
+    try:
+        os.makedirs(dirname)
+    except OSError, e:
+        if e.errno != errno.EEXIST:
+            raise
+    tmpfilename = '%s.%d.tmp' % (filename, os.getpid())
+    out = open(tmpfilename, 'wb')
+    p = subprocess.Popen(command, stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE)
+
+    def feed():
+        try:
+            p.stdin.write(request)
+        except IOError:
+            pass
+        p.stdin.close()
+    feeder = threading.Thread(target=feed)
+    feeder.start()
+
+    size = 0
+    keep = True
+    try:
+        try:
+            while True:
+                chunk = p.stdout.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                write_all(1, chunk)
+                if keep:
+                    size += len(chunk)
+                    if size > max_size // 4:
+                        # Too big to be worth caching.
+                        keep = False
+                    else:
+                        out.write(chunk)
+        except:
+            # Most likely the client went away; don't leave pack-objects
+            # blocked on a full pipe.
+            keep = False
+            p.kill()
+            raise
+    finally:
+        feeder.join()
+        rc = p.wait()
+        out.close()
+        if keep and rc == 0:
+            os.rename(tmpfilename, filename)
+        else:
+            os.remove(tmpfilename)
+    if keep and rc == 0:
+        evict(os.path.dirname(dirname), max_size)
+    return rc
+
+
+def main(argv):
+    command = argv[1:]
+    cache_dir = os.environ.get(ENV_DIR)
+    if not cache_dir:
+        os.execvp(command[0], command)
+    max_size = int(os.environ.get(ENV_SIZE, DEFAULT_SIZE))
+    request = read_all(0)
+    filename = os.path.join(cache_dir, repository_key(os.getcwd()),
+            request_key(command[1:], request) + PACK_EXT)
+    if serve_hit(filename):
+        return 0
+    return serve_miss(command, request, filename, max_size)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 3:
+        print >>sys.stderr, __doc__.replace('%prog',
+                os.path.basename(sys.argv[0]))
+        sys.exit(1)
+    sys.exit(main(sys.argv))
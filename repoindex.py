@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+"""\
+Maintain a persistent index of the repositories under a base path.
+
+USAGE: %prog base_path index_file
+
+Rebuild `index_file` from scratch by scanning every repository under
+`base_path`.  Run this whenever the index has drifted from the disk, for
+example after repositories were moved around by hand.
+
+The index is a plain text file containing one repository path (relative to
+the base path, e.g. "u/mark/foo.git") per line, in sorted order.
+git_ssh_server.py keeps it up to date as repositories are created, forked,
+and renamed, and answers `list` from it instead of walking the whole tree.
+"""
+
+# Make Python 2 act like Python 3.
+from __future__ import with_statement, division
+__metaclass__ = type        # default to new-style classes
+
+import sys, os
+import os.path
+import re
+import bisect
+import sre_parse
+import sre_constants
+from atomicfile import Lock, LockedAtomicFile
+from treescan import scan_tree
+
+
+def scan(base_path):
+    """Walk `base_path` and return a sorted list of all repository paths."""
+    return list(scan_tree(base_path))
+
+
+def literal_hints(pattern):
+    """Extract literal text that any match of the regular expression
+    `pattern` must contain.
+
+    Returns (`prefix`, `substrings`): if `prefix` is not None, every path
+    matched by ``re.search(pattern, path)`` starts with it; every such path
+    also contains each string in `substrings`.  The analysis is
+    conservative: anything it does not understand yields no hint.
+    """
+    parsed = sre_parse.parse(pattern)
+    state = getattr(parsed, 'pattern', None) or getattr(parsed, 'state')
+    if state.flags & (re.IGNORECASE | re.MULTILINE):
+        return None, []
+    items = list(parsed)
+    prefix = None
+    if items and items[0] in ((sre_constants.AT, sre_constants.AT_BEGINNING),
+            (sre_constants.AT, sre_constants.AT_BEGINNING_STRING)):
+        items.pop(0)
+        prefix = ''
+    substrings = []
+    run = ''
+    leading = True
+    for op, av in items:
+        if op == sre_constants.LITERAL and av < 128:
+            run += chr(av)
+            continue
+        if run:
+            substrings.append(run)
+            if leading and prefix is not None:
+                prefix = run
+        leading = False
+        run = ''
+    if run:
+        substrings.append(run)
+        if leading and prefix is not None:
+            prefix = run
+    if prefix == '':
+        prefix = None
+    return prefix, substrings
+
+
+def _tail(items, start):
+    for i in xrange(start, len(items)):
+        yield items[i]
+
+
+def search(paths, pattern=None, after=None):
+    """Yield the paths in `paths`, a sorted list or iterable, that match
+    the regular expression `pattern` (with ``re.search``; None matches
+    everything) and, if `after` is given, sort after `after`.
+
+    Literal text in the pattern is used to narrow the candidates before the
+    regular expression is run: an anchored prefix (e.g. "^u/alice/") selects
+    a contiguous slice of `paths` by binary search, and required substrings
+    (e.g. "project") are checked with a plain ``in`` test, which is much
+    cheaper than a regex search.
+    """
+    if pattern is not None:
+        r = re.compile(pattern)
+        prefix, substrings = literal_hints(pattern)
+    else:
+        r = None
+        prefix, substrings = None, []
+    if isinstance(paths, list):
+        start = 0
+        if prefix is not None:
+            start = bisect.bisect_left(paths, prefix)
+        if after is not None:
+            start = max(start, bisect.bisect_right(paths, after))
+        paths = _tail(paths, start)
+    for path in paths:
+        if after is not None and path <= after:
+            continue
+        if prefix is not None and not path.startswith(prefix):
+            if path > prefix:
+                break
+            continue
+        for s in substrings:
+            if s not in path:
+                break
+        else:
+            if r is None or r.search(path):
+                yield path
+
+
+class RepositoryIndex:
+    """
+    An on-disk, sorted list of repository paths.
+
+    The index is loaded lazily and reloaded whenever the file's mtime
+    changes, so a long-lived process always sees the updates made by others.
+    All updates are performed with a `LockedAtomicFile`, so concurrent
+    writers and readers are safe.
+
+    If the index file does not exist, `exists()` returns False and all
+    updates are silently ignored; callers should then fall back to a scan.
+    Use `rebuild()` (or run this module as a script) to create it.
+    """
+
+    _instances = {}
+
+    @classmethod
+    def get(cls, filename):
+        """Return the instance for `filename` shared by the whole
+        process."""
+        try:
+            return cls._instances[filename]
+        except KeyError:
+            index = cls._instances[filename] = cls(filename)
+            return index
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._mtime = None
+        self._paths = []
+
+    def exists(self):
+        return os.path.exists(self.filename)
+
+    def paths(self):
+        """Return the sorted list of repository paths."""
+        try:
+            mtime = os.stat(self.filename).st_mtime
+        except OSError:
+            self._mtime = None
+            self._paths = []
+            return self._paths
+        if mtime != self._mtime:
+            f = open(self.filename, 'r')
+            try:
+                self._paths = [line.rstrip('\n') for line in f if line.strip()]
+            finally:
+                f.close()
+            self._mtime = mtime
+        return self._paths
+
+    def __iter__(self):
+        return iter(self.paths())
+
+    def search(self, pattern):
+        """Yield the indexed paths that match the regular expression
+        `pattern`.  See `search()`."""
+        return search(self.paths(), pattern)
+
+    def __contains__(self, path):
+        paths = self.paths()
+        i = bisect.bisect_left(paths, path)
+        return i < len(paths) and paths[i] == path
+
+    def update(self, remove=(), add=()):
+        """Atomically remove the paths in `remove` and insert those in
+        `add`."""
+        if not self.exists():
+            return
+        remove = set(remove)
+        add = sorted(set(add) - remove)
+        with LockedAtomicFile(self.filename, autobreak=True) as f:
+            paths = [line.rstrip('\n') for line in f if line.strip()]
+            paths = [p for p in paths if p not in remove]
+            for path in add:
+                i = bisect.bisect_left(paths, path)
+                if i == len(paths) or paths[i] != path:
+                    paths.insert(i, path)
+            for path in paths:
+                f.write(path + '\n')
+            f.commit()
+        self._mtime = None
+
+    def add(self, path):
+        """Record that repository `path` was created."""
+        self.update(add=[path])
+
+    def remove(self, path):
+        """Record that repository `path` was removed."""
+        self.update(remove=[path])
+
+    def rename(self, old, new):
+        """Record that repository `old` was renamed to `new`."""
+        self.update(remove=[old], add=[new])
+
+    def rebuild(self, base_path):
+        """Replace the contents of the index with a fresh scan of
+        `base_path`."""
+        paths = scan(base_path)
+        with Lock(self.filename + LockedAtomicFile.LOCK_EXT, autobreak=True):
+            tmpfilename = self.filename + LockedAtomicFile.TMP_EXT
+            f = open(tmpfilename, 'w')
+            try:
+                for path in paths:
+                    f.write(path + '\n')
+            except:
+                f.close()
+                os.remove(tmpfilename)
+                raise
+            else:
+                f.flush()
+                os.fsync(f.fileno())
+                f.close()
+                os.rename(tmpfilename, self.filename)
+        self._mtime = None
+        return len(paths)
+
+
+def main(base_path, filename):
+    n = RepositoryIndex(filename).rebuild(base_path)
+    print >>sys.stderr, "Indexed %d repositories." % n
+
+
+if __name__ == "__main__":
+    try:
+        base_path, filename = sys.argv[1:]
+    except ValueError:
+        print >>sys.stderr, __doc__.replace('%prog',
+                os.path.basename(sys.argv[0]))
+        sys.exit(1)
+    main(base_path, filename)
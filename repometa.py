@@ -0,0 +1,337 @@
+#!/usr/bin/env python
+"""\
+Cache a summary of each repository, for `show` and `list --long`.
+
+USAGE: %prog [options] base_path stats_file
+
+Describing a repository (its size, branches, default branch, and last
+commit) takes several git processes.  If config['metadata'] is set,
+git_ssh_server.py instead computes the summary when the repository changes,
+i.e. after every push, create, and fork, and stores it as JSON in that file
+inside the repository (e.g. "info/metadata.json"), so that answering `show`
+takes a single file read.  A new repository's summary is known without
+running git at all (see `empty()`).  The record looks like this:
+
+    {"head": "refs/heads/master",
+     "branches": 3,
+     "tags": 1,
+     "size": 123456,
+     "last_commit": {"id": "...", "time": 1300000000,
+                     "author": "A U Thor", "subject": "Fix it"},
+     "last_push": 1300000000.5,
+     "updated": 1300000001.25}
+
+"size" is the size in bytes of the repository's own objects (not those it
+borrows through alternates).  "last_commit" is the commit at HEAD, or null
+if there is none; "last_push" is null if the repository was never pushed
+to.
+
+If config['stats'] is set, the main statistics of every repository are
+also appended to that file, which is shared by all repositories (see
+`RepositoryStats`), so that `list --long` can show and sort by them without
+opening each repository.
+
+Run this module as a script to recompute the summaries of all repositories
+under `base_path`, e.g. after enabling the feature or after moving
+repositories around by hand.
+"""
+
+# Make Python 2 act like Python 3.
+from __future__ import with_statement, division
+__metaclass__ = type        # default to new-style classes
+
+import sys, os
+import os.path
+import json
+import time
+import optparse
+import subprocess
+from atomicfile import Lock, LockedAtomicFile
+
+# The keys of a summary that are kept in the stats file.
+STATS_KEYS = ('size', 'branches', 'tags', 'last_push')
+
+
+def _git(git, repo, *args):
+    """Run git on `repo` and return its output, or None if it failed."""
+    p = subprocess.Popen([git, '--git-dir=%s' % repo] + list(args),
+            stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'))
+    out = p.communicate()[0]
+    if p.returncode != 0:
+        return None
+    return out
+
+
+def collect(git, repo, last_push=None):
+    """Compute the record of the repository at `repo`.  `git` is the path
+    to the git executable; `last_push` is the time of the last push, if
+    any."""
+    head = (_git(git, repo, 'symbolic-ref', '-q', 'HEAD') or '').strip()
+
+    branches = tags = 0
+    refs = _git(git, repo, 'for-each-ref', '--format=%(refname)',
+            'refs/heads', 'refs/tags') or ''
+    for ref in refs.splitlines():
+        if ref.startswith('refs/heads/'):
+            branches += 1
+        else:
+            tags += 1
+
+    size = 0
+    counts = _git(git, repo, 'count-objects', '-v') or ''
+    for line in counts.splitlines():
+        key, _, value = line.partition(': ')
+        if key in ('size', 'size-pack'):
+            size += int(value) * 1024
+
+    last_commit = None
+    log = _git(git, repo, 'log', '-1', '--format=%H%x00%ct%x00%an%x00%s',
+            'HEAD', '--')
+    if log:
+        fields = log.rstrip('\n').split('\0')
+        if len(fields) == 4:
+            last_commit = {
+                    'id' : fields[0],
+                    'time' : int(fields[1]),
+                    'author' : fields[2],
+                    'subject' : fields[3],
+                    }
+
+    return {
+            'head' : head or None,
+            'branches' : branches,
+            'tags' : tags,
+            'size' : size,
+            'last_commit' : last_commit,
+            'last_push' : last_push,
+            'updated' : time.time(),
+            }
+
+
+def empty(repo):
+    """Return the record of the new, empty repository at `repo`, without
+    running git."""
+    head = None
+    try:
+        f = open(os.path.join(repo, 'HEAD'))
+    except IOError:
+        pass
+    else:
+        try:
+            line = f.readline().strip()
+        finally:
+            f.close()
+        if line.startswith('ref: '):
+            head = line[len('ref: '):]
+    return {
+            'head' : head,
+            'branches' : 0,
+            'tags' : 0,
+            'size' : 0,
+            'last_commit' : None,
+            'last_push' : None,
+            'updated' : time.time(),
+            }
+
+
+def read(repo, filename):
+    """Return the record stored in `filename` (relative to `repo`), or None
+    if there is none."""
+    try:
+        f = open(os.path.join(repo, filename))
+    except IOError:
+        return None
+    try:
+        return json.load(f)
+    except ValueError:
+        return None
+    finally:
+        f.close()
+
+
+def write(repo, filename, record):
+    """Atomically store `record` in `filename` (relative to `repo`)."""
+    filename = os.path.join(repo, filename)
+    dirname = os.path.dirname(filename)
+    if not os.path.isdir(dirname):
+        os.makedirs(dirname)
+    tmpfilename = '%s.%d.tmp' % (filename, os.getpid())
+    f = open(tmpfilename, 'w')
+    try:
+        json.dump(record, f, sort_keys=True)
+    finally:
+        f.close()
+    os.rename(tmpfilename, filename)
+
+
+def stats_of(record):
+    """Return the part of the summary `record` kept in the stats file,
+    including the time of the last activity (the last push, or else the last
+    commit)."""
+    out = dict((key, record.get(key)) for key in STATS_KEYS)
+    commit = record.get('last_commit')
+    out['last_active'] = record.get('last_push') or (commit and commit['time'])
+    return out
+
+
+class RepositoryStats:
+    """
+    The statistics of every repository, in one append-only file.
+
+    Each line is a JSON object with the repository's "path" (relative to the
+    base path) and its `stats_of()`; the last line for a path wins, and a
+    line with only a path removes it.  The file is read once per process and
+    then only its new lines are read, so a long-lived process keeps up with
+    the writers cheaply.  When most of the lines are stale, a reader rewrites
+    the file with only the current ones.
+    """
+
+    _instances = {}
+
+    # Compact when there are more than this many lines per repository...
+    COMPACT_RATIO = 2
+    # ... and at least this many lines in all.
+    COMPACT_MIN = 1000
+
+    @classmethod
+    def get(cls, filename):
+        """Return the instance for `filename` shared by the whole
+        process."""
+        try:
+            return cls._instances[filename]
+        except KeyError:
+            stats = cls._instances[filename] = cls(filename)
+            return stats
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._table = {}
+        self._ino = None
+        self._offset = 0
+        self._lines = 0
+
+    def _lock(self):
+        return Lock(self.filename + LockedAtomicFile.LOCK_EXT, autobreak=True)
+
+    def _append(self, entries):
+        data = ''.join(json.dumps(entry, sort_keys=True) + '\n'
+                       for entry in entries)
+        with self._lock():
+            fd = os.open(self.filename,
+                    os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0666)
+            try:
+                os.write(fd, data)
+            finally:
+                os.close(fd)
+
+    def record(self, path, record):
+        """Store the statistics of the summary `record` of `path`."""
+        entry = stats_of(record)
+        entry['path'] = path
+        self._append([entry])
+
+    def remove(self, path):
+        self._append([{'path' : path}])
+
+    def rename(self, old, new):
+        entry = dict(self.table().get(old) or {})
+        entry['path'] = new
+        self._append([{'path' : old}, entry])
+
+    def table(self):
+        """Return a dictionary mapping each path to its statistics."""
+        try:
+            st = os.stat(self.filename)
+        except OSError:
+            self._table, self._ino, self._offset, self._lines = {}, None, 0, 0
+            return self._table
+        if st.st_ino != self._ino or st.st_size < self._offset:
+            self._table, self._ino, self._offset, self._lines = \
+                    {}, st.st_ino, 0, 0
+        if st.st_size > self._offset:
+            f = open(self.filename)
+            try:
+                f.seek(self._offset)
+                data = f.read()
+            finally:
+                f.close()
+            end = data.rfind('\n') + 1     # ignore a partly written line
+            for line in data[:end].splitlines():
+                try:
+                    entry = json.loads(line)
+                    path = entry.pop('path')
+                except (ValueError, KeyError):
+                    continue
+                self._lines += 1
+                if entry:
+                    self._table[path] = entry
+                else:
+                    self._table.pop(path, None)
+            self._offset += end
+            if (self._lines >= self.COMPACT_MIN
+                    and self._lines > self.COMPACT_RATIO * len(self._table)):
+                self.compact()
+        return self._table
+
+    def compact(self, table=None):
+        """Rewrite the file with one line per repository.  If `table` (a
+        dictionary like that returned by `table()`) is given, it replaces
+        the contents of the file."""
+        if not os.path.exists(self.filename):
+            if table is None:
+                return
+            open(self.filename, 'a').close()
+        with LockedAtomicFile(self.filename, autobreak=True) as f:
+            if table is None:
+                table = {}
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        path = entry.pop('path')
+                    except (ValueError, KeyError):
+                        continue
+                    if entry:
+                        table[path] = entry
+                    else:
+                        table.pop(path, None)
+            for path in sorted(table):
+                entry = dict(table[path])
+                entry['path'] = path
+                f.write(json.dumps(entry, sort_keys=True) + '\n')
+            f.commit()
+        # Read the new file from scratch next time.
+        self._ino = None
+
+
+def main(argv):
+    parser = optparse.OptionParser(usage='%prog [options] base_path '
+            'stats_file')
+    parser.add_option('--git', default='git',
+            help='path to the git executable [%default]')
+    parser.add_option('--metadata', default='info/metadata.json',
+            help='where to store the summary in each repository '
+            '[%default]')
+    parser.add_option('--agefile', default='info/web/last-modified',
+            help='the file that records the last push [%default]')
+    options, args = parser.parse_args(argv[1:])
+    if len(args) != 2:
+        parser.error('expected a base path and a stats file')
+    base_path, stats_file = args
+    from treescan import scan_tree
+    table = {}
+    for relpath in scan_tree(base_path):
+        repo = os.path.join(base_path, relpath)
+        try:
+            last_push = os.stat(os.path.join(repo, options.agefile)).st_mtime
+        except OSError:
+            last_push = None
+        record = collect(options.git, repo, last_push)
+        write(repo, options.metadata, record)
+        table[relpath] = stats_of(record)
+    RepositoryStats(stats_file).compact(table)
+    print "Summarized %d repositories." % len(table)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv))
@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+"""\
+Watch a repository tree with inotify and keep derived state up to date.
+
+USAGE: %prog [--sharded] base_path index_file [cgitrc_file]
+
+Follow directory creation, deletion, and renames under `base_path` and apply
+them to the repository index `index_file` as they happen.  If `cgitrc_file`
+is given, it is generated incrementally (see generate_cgitrc.py) at
+startup, and afterwards only the entries of the repositories that appeared
+or disappeared are updated, without rescanning the tree.  With --sharded,
+`cgitrc_file` is generated as with "generate_cgitrc.py --sharded", and only
+the shards of the owners concerned are rewritten.  This program runs until
+killed.
+
+The watcher is Linux-only; it talks to inotify(7) through ctypes.
+"""
+
+# Make Python 2 act like Python 3.
+from __future__ import with_statement, division
+__metaclass__ = type        # default to new-style classes
+
+import sys, os
+import os.path
+import errno
+import struct
+import ctypes
+import ctypes.util
+
+
+class InotifyError (OSError): pass
+
+
+# Constants from <sys/inotify.h>.
+IN_MOVED_FROM   = 0x00000040
+IN_MOVED_TO     = 0x00000080
+IN_CREATE       = 0x00000100
+IN_DELETE       = 0x00000200
+IN_Q_OVERFLOW   = 0x00004000
+IN_IGNORED      = 0x00008000
+IN_ONLYDIR      = 0x01000000
+IN_ISDIR        = 0x40000000
+IN_CLOEXEC      = 0x00080000
+
+
+class Inotify:
+    """A minimal ctypes wrapper around the inotify system calls."""
+
+    EVENT_HEADER = struct.Struct('iIII')
+    BUFSIZE = 65536
+
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                ctypes.c_uint32]
+        self._rm_watch = libc.inotify_rm_watch
+        self._rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise('inotify_init1')
+
+    def _raise(self, what, path=None):
+        e = ctypes.get_errno()
+        raise InotifyError(e, '%s: %s' % (what, os.strerror(e)), path)
+
+    def add_watch(self, path, mask):
+        """Watch `path` for the events in `mask`; return the watch
+        descriptor."""
+        wd = self._add_watch(self.fd, path, mask)
+        if wd < 0:
+            self._raise('inotify_add_watch', path)
+        return wd
+
+    def rm_watch(self, wd):
+        """Stop watching `wd`.  Errors (e.g. the watch is already gone) are
+        ignored."""
+        self._rm_watch(self.fd, wd)
+
+    def read(self):
+        """Block until events are available, then return a list of
+        (wd, mask, cookie, name) tuples."""
+        while True:
+            try:
+                buf = os.read(self.fd, self.BUFSIZE)
+            except OSError, e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            break
+        events = []
+        header = self.EVENT_HEADER
+        i = 0
+        while i + header.size <= len(buf):
+            wd, mask, cookie, length = header.unpack_from(buf, i)
+            i += header.size
+            name = buf[i:i+length].rstrip('\0')
+            i += length
+            events.append((wd, mask, cookie, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class RepositoryWatcher:
+    """
+    Track the set of repositories under `base_path` as it changes.
+
+    Every directory that is not itself a repository is watched, so that new
+    namespaces (e.g. "u/newuser/") are picked up as soon as they appear.  The
+    inside of a repository is never watched.
+
+    Subscribers registered with `subscribe()` are called as `callback(added,
+    removed)` with the lists of repository paths (relative to `base_path`)
+    that appeared and disappeared since the last call.  A rename is reported
+    as the removal of the old path and the addition of the new one.
+    """
+
+    MASK = (IN_CREATE | IN_DELETE | IN_MOVED_FROM | IN_MOVED_TO
+            | IN_ONLYDIR)
+
+    def __init__(self, base_path):
+        self.base_path = base_path
+        self.inotify = Inotify()
+        self.repos = set()
+        self.watches = {}           # wd -> directory relative to base_path
+        self.subscribers = []
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def publish(self, added, removed):
+        if not added and not removed:
+            return
+        added = sorted(added)
+        removed = sorted(removed)
+        for callback in self.subscribers:
+            callback(added, removed)
+
+    def _realpath(self, relpath):
+        return os.path.join(self.base_path, relpath)
+
+    def _watch(self, relpath):
+        try:
+            wd = self.inotify.add_watch(self._realpath(relpath), self.MASK)
+        except InotifyError, e:
+            # The directory vanished before we could watch it.
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return
+            raise
+        self.watches[wd] = relpath
+
+    def _appear(self, relpath, added):
+        """Handle the appearance of directory `relpath`, which may contain
+        an arbitrary tree that was created before we started watching
+        it."""
+        if relpath.endswith('.git'):
+            self.repos.add(relpath)
+            added.add(relpath)
+            return
+        self._watch(relpath)
+        try:
+            names = os.listdir(self._realpath(relpath))
+        except OSError:
+            return
+        for name in sorted(names):
+            child = os.path.join(relpath, name) if relpath else name
+            if os.path.isdir(self._realpath(child)):
+                self._appear(child, added)
+
+    def _disappear(self, relpath, removed):
+        """Handle the disappearance of directory `relpath` and everything
+        below it."""
+        subtree = relpath + '/'
+        for repo in [r for r in self.repos
+                     if r == relpath or r.startswith(subtree)]:
+            self.repos.discard(repo)
+            removed.add(repo)
+        for wd, path in self.watches.items():
+            if path == relpath or path.startswith(subtree):
+                self.inotify.rm_watch(wd)
+                del self.watches[wd]
+
+    def start(self):
+        """Watch the whole tree and record the repositories that exist now.
+        Nothing is published for them."""
+        self._appear('', set())
+
+    def rescan(self):
+        """Forget everything and rescan from scratch, publishing the
+        difference.  Used when the kernel's event queue overflows."""
+        old = self.repos
+        for wd in self.watches.keys():
+            self.inotify.rm_watch(wd)
+        self.watches = {}
+        self.repos = set()
+        self._appear('', set())
+        self.publish(self.repos - old, old - self.repos)
+
+    def process(self):
+        """Wait for and handle one batch of events."""
+        added = set()
+        removed = set()
+        overflow = False
+        for wd, mask, cookie, name in self.inotify.read():
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                break
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            if not (mask & IN_ISDIR) or wd not in self.watches:
+                continue
+            parent = self.watches[wd]
+            relpath = os.path.join(parent, name) if parent else name
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                removed.discard(relpath)
+                self._appear(relpath, added)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                self._disappear(relpath, removed)
+        # A repository that came and went within one batch is not news.
+        both = added & removed
+        self.publish(added - both, removed - both)
+        if overflow:
+            self.rescan()
+
+    def run(self):
+        self.start()
+        while True:
+            self.process()
+
+
+def main(base_path, index_filename, cgitrc_filename=None, sharded=False):
+    from repoindex import RepositoryIndex
+    index = RepositoryIndex(index_filename)
+    watcher = RepositoryWatcher(base_path)
+
+    def update_index(added, removed):
+        index.update(remove=removed, add=added)
+    watcher.subscribe(update_index)
+
+    if cgitrc_filename is not None:
+        import generate_cgitrc
+        def update_cgitrc(added, removed):
+            generate_cgitrc.apply_changes(base_path, cgitrc_filename,
+                    added, removed, sharded)
+        watcher.subscribe(update_cgitrc)
+
+    # Catch anything that changed while we were not running.
+    watcher.start()
+    index.rebuild(base_path)
+    if cgitrc_filename is not None:
+        generate_cgitrc.main(base_path, cgitrc_filename, incremental=True,
+                sharded=sharded)
+    while True:
+        watcher.process()
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sharded = args[:1] == ['--sharded']
+    if sharded:
+        args.pop(0)
+    if not 2 <= len(args) <= 3:
+        print >>sys.stderr, __doc__.replace('%prog',
+                os.path.basename(sys.argv[0]))
+        sys.exit(1)
+    try:
+        main(*args, sharded=sharded)
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,139 @@
+"""
+Prebuilt snapshots of an empty repository, for fast `create`.
+
+Running "git init" for every new repository costs a git process and a copy
+of every file in the template directory.  A `Snapshot` instead builds the
+empty repository once for each version of the template, in
+"snapshot_dir/VERSION/repo", and `materialize()` makes new repositories
+from it with reflinks (see cowcopy.py) where the filesystem supports them
+and hard links otherwise.  The version is a fingerprint of the template
+directory, so the snapshot is rebuilt only after the template changes.
+
+The template's hooks are not copied into each repository: they are kept
+once in "snapshot_dir/VERSION/hooks", which every repository made from that
+version refers to with core.hooksPath (git 2.9 or later).  Old versions are
+therefore never deleted automatically; remove one only once no repository
+refers to its hooks.
+
+Hard links are safe because git never rewrites a file in place: it writes a
+new file and renames it over the old one.  The few files people commonly
+edit by hand are copied instead.
+"""
+
+# Make Python 2 act like Python 3.
+from __future__ import with_statement, division
+__metaclass__ = type        # default to new-style classes
+
+import os
+import os.path
+import errno
+import hashlib
+import shutil
+import tempfile
+import cowcopy
+
+# Files that are copied rather than hard-linked, since they may be edited
+# in place.
+COPIED = ('config', 'description', 'HEAD')
+
+
+def fingerprint(template):
+    """Return a string that changes whenever a file in the directory
+    `template` is added, removed, or modified."""
+    h = hashlib.sha1(os.path.abspath(template))
+    for dirpath, dirnames, filenames in os.walk(template):
+        dirnames.sort()
+        for name in sorted(filenames):
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+            except OSError:
+                continue
+            h.update('%s\0%o %d %d\0' % (os.path.relpath(path, template),
+                    st.st_mode, st.st_size, int(st.st_mtime * 1e6)))
+    return h.hexdigest()[:16]
+
+
+def hardlink(src, dst):
+    """Hard-link `src` to `dst`, or copy it if it is one of COPIED or on
+    another filesystem."""
+    if os.path.basename(src) not in COPIED:
+        try:
+            os.link(src, dst)
+            return
+        except OSError, e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+                raise
+    shutil.copy2(src, dst)
+
+
+class Snapshot:
+    """
+    The empty repository made from `template`, kept in `snapshot_dir`.
+    `git` is a function that runs git with the given arguments and returns
+    its exit status (e.g. `Backend.git`).
+    """
+
+    def __init__(self, snapshot_dir, template, git):
+        self.snapshot_dir = snapshot_dir
+        self.template = template
+        self.git = git
+
+    def path(self):
+        """Return the directory of the current version."""
+        return os.path.join(self.snapshot_dir, fingerprint(self.template))
+
+    def build(self, path):
+        """Build the version in `path` (if nobody else has), and return
+        True if it exists afterwards."""
+        if os.path.isdir(path):
+            return True
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        # Threads (e.g. in `bulk`) share the pid, so let mkdtemp pick a
+        # unique name.
+        tmp = tempfile.mkdtemp(prefix=os.path.basename(path) + '.',
+                suffix='.tmp', dir=parent)
+        os.chmod(tmp, 0755)     # mkdtemp makes it private
+        try:
+            repo = os.path.join(tmp, 'repo')
+            rc = self.git("init", bare=True, quiet=True, git_dir=repo,
+                    template=self.template)
+            if rc != 0:
+                return False
+            hooks = os.path.join(repo, 'hooks')
+            if os.path.isdir(hooks):
+                os.rename(hooks, os.path.join(tmp, 'hooks'))
+            else:
+                os.mkdir(os.path.join(tmp, 'hooks'))
+            rc = self.git("config", "core.hooksPath",
+                    os.path.join(os.path.abspath(path), 'hooks'),
+                    git_dir=repo)
+            if rc != 0:
+                return False
+            try:
+                os.rename(tmp, path)
+            except OSError:
+                # Someone else built it first.
+                pass
+        finally:
+            shutil.rmtree(tmp, ignore_errors=True)
+        return os.path.isdir(path)
+
+    def materialize(self, dst):
+        """Make a new, empty repository at `dst`, whose parent directory
+        must exist.  Returns False if the snapshot could not be built."""
+        path = self.path()
+        if not self.build(path):
+            return False
+        if cowcopy.supports_reflink(os.path.dirname(os.path.abspath(dst))):
+            copy = cowcopy.reflink
+        else:
+            copy = hardlink
+        cowcopy.copytree(os.path.join(path, 'repo'), dst, copy)
+        return True
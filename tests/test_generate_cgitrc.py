@@ -0,0 +1,75 @@
+"""
+Regression tests for generate_cgitrc.py.
+
+Run with "python -m unittest discover tests" from the top directory.
+"""
+
+import sys, os
+import os.path
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+        __file__))))
+import generate_cgitrc
+
+
+class NonAsciiDescriptionTest(unittest.TestCase):
+
+    DESCRIPTIONS = {
+            'u/utf8.git' : 'Caf\xc3\xa9 repo',
+            'u/latin1.git' : 'Caf\xe9 repo',
+            }
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.base = os.path.join(self.tmpdir, 'repos')
+        for url, desc in self.DESCRIPTIONS.items():
+            os.makedirs(os.path.join(self.base, url))
+            f = open(os.path.join(self.base, url, 'description'), 'w')
+            f.write(desc + '\n')
+            f.close()
+        self.outfile = os.path.join(self.tmpdir, 'cgitrc')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def read(self, filename):
+        f = open(filename, 'rb')
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def check(self, data):
+        for desc in self.DESCRIPTIONS.values():
+            self.assertTrue('repo.desc=%s\n' % desc in data)
+
+    def test_incremental(self):
+        # The second and third runs use the entries cached in the state.
+        for i in range(3):
+            generate_cgitrc.main(self.base, self.outfile, incremental=True)
+            self.check(self.read(self.outfile))
+
+    def test_sharded(self):
+        for i in range(3):
+            generate_cgitrc.main(self.base, self.outfile, incremental=True,
+                    sharded=True)
+            self.check(self.read(os.path.join(self.outfile + '.d', 'u',
+                                              'utf8.cgitrc'))
+                       + self.read(os.path.join(self.outfile + '.d', 'u',
+                                                'latin1.cgitrc')))
+
+    def test_apply_changes(self):
+        generate_cgitrc.main(self.base, self.outfile, incremental=True)
+        os.makedirs(os.path.join(self.base, 'u', 'new.git'))
+        generate_cgitrc.apply_changes(self.base, self.outfile,
+                ['u/new.git'], [])
+        data = self.read(self.outfile)
+        self.check(data)
+        self.assertTrue('repo.url=u/new.git\n' in data)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,190 @@
+"""
+Find the repositories under a base path, in parallel.
+
+Walking a large tree is dominated by the latency of reading directories
+and, with os.walk(), of stat()ing every entry to tell directories from
+files; on NFS each of those is a round trip.  `scan_tree()` lists
+directories with scandir(), whose entries usually say whether they are
+directories without a stat(), and spreads the work over a pool of threads:
+each owner directory (e.g. "u/mark" or "g/admins") is walked by one thread,
+so the round trips of different owners overlap.
+
+scandir() is os.scandir() on Python 3.5 and later, or the `scandir` module
+if it is installed; otherwise each entry is stat()ed as os.walk() would.
+
+The paths are yielded in sorted order, just as `repoindex.scan()` returns
+them, and the first ones are yielded as soon as they are found.
+"""
+
+# Make Python 2 act like Python 3.
+from __future__ import with_statement, division
+__metaclass__ = type        # default to new-style classes
+
+import os
+import os.path
+import stat
+import threading
+import Queue
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+DEFAULT_JOBS = 8
+
+# Owner directories are this many levels below the base path.
+OWNER_DEPTH = 2
+
+
+def _entries(path):
+    """Return a list of (name, is_dir) for the entries of directory `path`,
+    not following symbolic links, or [] if it cannot be read."""
+    try:
+        if scandir is not None:
+            return [(e.name, e.is_dir(follow_symlinks=False))
+                    for e in scandir(path)]
+        out = []
+        for name in os.listdir(path):
+            try:
+                mode = os.lstat(os.path.join(path, name)).st_mode
+            except OSError:
+                continue
+            out.append((name, stat.S_ISDIR(mode)))
+        return out
+    except OSError:
+        return []
+
+
+def _sort_key(name):
+    # Visiting "x" as "x/" makes a preorder walk produce sorted paths: "x/y"
+    # sorts between "x.git" and "x0".
+    return name + '/'
+
+
+def _before(subtree, after):
+    """Return True if every path in directory `subtree` (which ends with a
+    slash) sorts before `after`."""
+    return subtree < after and not after.startswith(subtree)
+
+
+def _outside(subtree, prefix):
+    """Return True if no path in directory `subtree` (which ends with a
+    slash) can start with `prefix`."""
+    return not (subtree.startswith(prefix) or prefix.startswith(subtree))
+
+
+def _children(base_path, rel, after, prefix):
+    """Return the sorted subdirectories of `rel` (relative to `base_path`)
+    as relative paths, skipping those that hold nothing after `after` or
+    nothing that starts with `prefix`."""
+    names = sorted((name for name, is_dir in
+                    _entries(os.path.join(base_path, rel)) if is_dir),
+                   key=_sort_key)
+    out = []
+    for name in names:
+        path = rel + '/' + name if rel else name
+        if after is not None and _before(path + '/', after):
+            continue
+        if prefix is not None and _outside(path + '/', prefix):
+            continue
+        out.append(path)
+    return out
+
+
+def _walk(base_path, rel, after, prefix, out):
+    """Append the repositories in the subtree `rel` to `out`, in order."""
+    for path in _children(base_path, rel, after, prefix):
+        if path.endswith('.git'):
+            if after is None or path > after:
+                out.append(path)
+        else:
+            _walk(base_path, path, after, prefix, out)
+
+
+def _plan(base_path, rel, depth, after, prefix, plan):
+    """Append ('repo', path) and ('tree', path) items to `plan`, in order:
+    the repositories above the owner directories, and the owner directories
+    to be walked by the workers."""
+    for path in _children(base_path, rel, after, prefix):
+        if path.endswith('.git'):
+            if after is None or path > after:
+                plan.append(('repo', path))
+        elif depth + 1 >= OWNER_DEPTH:
+            plan.append(('tree', path))
+        else:
+            _plan(base_path, path, depth + 1, after, prefix, plan)
+
+
+def scan_tree(base_path, jobs=DEFAULT_JOBS, after=None, prefix=None):
+    """Yield the paths (relative to `base_path`) of all repositories under
+    `base_path`, in sorted order, using up to `jobs` threads.  If `after` is
+    given, only paths that sort after it are yielded, and subtrees that hold
+    no such paths are not visited.  Likewise, if `prefix` is given, subtrees
+    that hold no path starting with it are not visited (the caller must
+    still check the paths it gets)."""
+    base_path = base_path.rstrip('/') or '/'
+    plan = []
+    _plan(base_path, '', 0, after, prefix, plan)
+    trees = [path for kind, path in plan if kind == 'tree']
+    if jobs <= 1 or len(trees) <= 1:
+        for kind, path in plan:
+            if kind == 'repo':
+                yield path
+            else:
+                out = []
+                _walk(base_path, path, after, prefix, out)
+                for p in out:
+                    yield p
+        return
+
+    results = {}        # tree -> list of repositories, once walked
+    done = threading.Condition()
+    queue = Queue.Queue()
+    for path in trees:
+        queue.put(path)
+
+    def worker():
+        while True:
+            try:
+                path = queue.get_nowait()
+            except Queue.Empty:
+                return
+            out = []
+            try:
+                _walk(base_path, path, after, prefix, out)
+            finally:
+                with done:
+                    results[path] = out
+                    done.notify_all()
+
+    threads = [threading.Thread(target=worker)
+               for i in range(min(jobs, len(trees)))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    try:
+        for kind, path in plan:
+            if kind == 'repo':
+                yield path
+                continue
+            with done:
+                while path not in results:
+                    done.wait()
+                out = results.pop(path)
+            for p in out:
+                yield p
+    finally:
+        # If the caller stops early, let the workers finish the queue
+        # without walking it, then wait for them, so that none is still
+        # running at interpreter shutdown.
+        while True:
+            try:
+                queue.get_nowait()
+            except Queue.Empty:
+                break
+        for t in threads:
+            t.join()